@@ -0,0 +1,261 @@
+from AdoDocument import AdoDocument, separator, resetVocabulary
+from AdoCorpus import AdoCorpus
+from multiprocessing import Pool
+from array import array
+import numpy as np
+import json, os, shutil
+
+'''
+    Corpus of ADO Documents in an indexed, columnar format that can be memory-mapped.
+    The file is made of:
+    - a magic string and the length of the JSON header;
+    - the JSON header, with the n. of documents and the offset, type and length of every section;
+    - the sections (8-byte aligned): for every document, the offsets of its ID, hashtags and tokens
+      in the flat arrays holding the IDs (UTF-8 bytes) and the hashtags and tokens (as ids in a vocabulary
+      shared by both); the vocabulary (offsets and UTF-8 bytes of the terms); the count of every
+      document, only if some document stands for duplicates collapsed into it.
+    Documents can be accessed by position (len(), indexing and slicing), in sequence (the same
+    iterator interface of AdoCorpus), and their text only can be read without building AdoDocuments.
+'''
+
+magic = b'ADOCORP1'
+extension = 'adc'
+
+# Temporary files holding the flat sections while writing, indexed by section
+flatSections = {'id_bytes': np.uint8, 'hashtag_ids': np.uint32, 'token_ids': np.uint32}
+
+
+class AdoColumnarCorpus:
+
+    def __init__(self, inFile):
+        self.file = f'{inFile}.{extension}'
+        self.next = 0
+        self.mmap = None
+        self.sections = None
+        self.vocabulary = None
+        self.writer = None
+
+    def __getstate__(self):
+        # Only the file name is passed to other processes, that map the file on their own
+        return {'file': self.file}
+
+    def __setstate__(self, state):
+        self.__init__(state['file'][:-len(extension) - 1])
+
+    def open(self):
+        if self.mmap is not None:
+            return self
+        self.mmap = np.memmap(self.file, dtype=np.uint8, mode='r')
+        if bytes(self.mmap[0:len(magic)]) != magic:
+            raise ValueError(f'{self.file} is not a columnar corpus')
+        header_length = int(self.mmap[len(magic):len(magic) + 8].view(np.uint64)[0])
+        header = json.loads(bytes(self.mmap[len(magic) + 8:len(magic) + 8 + header_length]).decode('UTF-8'))
+        self.n_documents = header['n_documents']
+        self.sections = {name: self.mmap[s['offset']:s['offset'] + s['count'] * np.dtype(s['dtype']).itemsize].view(
+            s['dtype']) for (name, s) in header['sections'].items()}
+        return self
+
+    def vocabularyTerms(self):
+        if self.vocabulary is None:
+            self.open()
+            offsets = self.sections['vocabulary_offsets']
+            data = bytes(self.sections['vocabulary_bytes'])
+            self.vocabulary = np.array([data[offsets[i]:offsets[i + 1]].decode('UTF-8')
+                                        for i in range(len(offsets) - 1)], dtype=object)
+        return self.vocabulary
+
+    def __len__(self):
+        return self.open().n_documents
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.document(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('document index out of range')
+        return self.document(i)
+
+    def terms(self, name, i):
+        offsets = self.sections[f'{name}_offsets']
+        return self.vocabularyTerms()[self.sections[f'{name}_ids'][offsets[i]:offsets[i + 1]]]
+
+    def document(self, i):
+        offsets = self.open().sections['id_offsets']
+        return AdoDocument(bytes(self.sections['id_bytes'][offsets[i]:offsets[i + 1]]).decode('UTF-8'),
+                           separator.join(self.terms('hashtag', i)),
+                           separator.join(self.terms('token', i)),
+                           int(self.sections['counts'][i]) if 'counts' in self.sections else 1)
+
+    # Return the count of all the documents (the n. of documents every one stands for)
+    def counts(self):
+        if 'counts' in self.open().sections:
+            return self.sections['counts'].tolist()
+        return [1] * len(self)
+
+    # Return the text (tokens joined by spaces) of the documents from start to stop (excluded), read by
+    # a pool of workers processes (each one a shard of the documents) if more than one
+    def texts(self, start=0, stop=None, workers=1):
+        stop = len(self) if stop is None else min(stop, len(self))
+        if workers > 1 and stop - start > workers:
+            return parallelTexts(self, workers, start, stop)
+        return [' '.join(self.terms('token', i)) for i in range(start, stop)]
+
+    # Return the text and the count of all the documents
+    def textsAndCounts(self, workers=1):
+        return (self.texts(workers=workers), self.counts())
+
+    # Return the text of the documents in batches of batch_size documents
+    def textBatches(self, batch_size):
+        for i in range(0, len(self), batch_size):
+            yield self.texts(i, i + batch_size)
+
+    # Return the text and the count of the documents in batches of batch_size documents
+    def textAndCountBatches(self, batch_size):
+        counts = self.counts()
+        for i in range(0, len(self), batch_size):
+            yield (self.texts(i, i + batch_size), counts[i:i + batch_size])
+
+    # Return the range of documents of shard i out of n shards of the documents from start to stop (excluded)
+    def shard(self, i, n, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        size = -(-(stop - start) // n)
+        return (min(start + i * size, stop), min(start + (i + 1) * size, stop))
+
+    def __iter__(self):
+        self.next = 0
+        return self
+
+    def __next__(self):
+        if self.next >= len(self):
+            raise StopIteration()
+        self.next += 1
+        return self.document(self.next - 1)
+
+    def save(self, obj):
+        if self.writer is None:
+            self.writer = {
+                'vocabulary': {},
+                'offsets': {'id': array('Q', [0]), 'hashtag': array('Q', [0]), 'token': array('Q', [0])},
+                'counts': array('I'),
+                'handles': {name: open(f'{self.file}.{name}.tmp', 'wb') for name in flatSections}
+            }
+
+        vocabulary = self.writer['vocabulary']
+        offsets = self.writer['offsets']
+        handles = self.writer['handles']
+        id_bytes = str(obj.id).encode('UTF-8')
+        handles['id_bytes'].write(id_bytes)
+        self.writer['counts'].append(obj.count)
+        offsets['id'].append(offsets['id'][-1] + len(id_bytes))
+        for (name, terms) in (('hashtag', obj.hashtags), ('token', obj.tokens)):
+            ids = array('I', [vocabulary.setdefault(t, len(vocabulary)) for t in terms])
+            handles[f'{name}_ids'].write(ids.tobytes())
+            offsets[name].append(offsets[name][-1] + len(ids))
+
+    def close(self):
+        if self.writer is not None:
+            self.write()
+            self.writer = None
+        self.mmap = None
+        self.sections = None
+
+    # Write the header and the sections, then remove the temporary files
+    def write(self):
+        terms = [t.encode('UTF-8') for t in self.writer['vocabulary']]
+        vocabulary_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+        vocabulary_offsets[1:] = np.cumsum([len(t) for t in terms], dtype=np.uint64)
+        for handle in self.writer['handles'].values():
+            handle.close()
+
+        # Sections as (name, dtype, count, content) where content is an array or a temporary file
+        sections = [
+            ('id_offsets', np.uint64, len(self.writer['offsets']['id']), np.frombuffer(self.writer['offsets']['id'], dtype=np.uint64)),
+            ('hashtag_offsets', np.uint64, len(self.writer['offsets']['hashtag']), np.frombuffer(self.writer['offsets']['hashtag'], dtype=np.uint64)),
+            ('token_offsets', np.uint64, len(self.writer['offsets']['token']), np.frombuffer(self.writer['offsets']['token'], dtype=np.uint64)),
+            ('vocabulary_offsets', np.uint64, len(vocabulary_offsets), vocabulary_offsets),
+            ('vocabulary_bytes', np.uint8, int(vocabulary_offsets[-1]), np.frombuffer(b''.join(terms), dtype=np.uint8))
+        ] + [(name, dtype, os.path.getsize(f'{self.file}.{name}.tmp') // np.dtype(dtype).itemsize, f'{self.file}.{name}.tmp')
+             for (name, dtype) in flatSections.items()]
+        if any(c != 1 for c in self.writer['counts']):
+            sections.append(('counts', np.uint32, len(self.writer['counts']), np.frombuffer(self.writer['counts'], dtype=np.uint32)))
+
+        def align(n):
+            return -(-n // 8) * 8
+
+        # The header is padded, to leave room for the offsets growing once the header length is added to them
+        header = {'version': 1, 'n_documents': len(self.writer['offsets']['id']) - 1, 'sections': {}}
+        offset = 0
+        for (name, dtype, count, content) in sections:
+            header['sections'][name] = {'offset': offset, 'dtype': np.dtype(dtype).str, 'count': count}
+            offset = align(offset + count * np.dtype(dtype).itemsize)
+        header_length = align(len(json.dumps(header).encode('UTF-8')) + 20 * len(sections))
+        start = len(magic) + 8 + header_length
+        for s in header['sections'].values():
+            s['offset'] += start
+        header_bytes = json.dumps(header).encode('UTF-8')
+        assert len(header_bytes) <= header_length
+        header_bytes = header_bytes.ljust(header_length)
+
+        with open(self.file, 'wb') as f:
+            f.write(magic)
+            f.write(np.array([header_length], dtype=np.uint64).tobytes())
+            f.write(header_bytes)
+            for (name, dtype, count, content) in sections:
+                f.seek(header['sections'][name]['offset'])
+                if isinstance(content, str):
+                    with open(content, 'rb') as tmp:
+                        shutil.copyfileobj(tmp, f)
+                    os.remove(content)
+                else:
+                    f.write(content.tobytes())
+
+
+'''
+    Open a corpus in the columnar format if it exists, otherwise in the pickle format
+'''
+
+
+def openCorpus(inFile):
+    if os.path.exists(f'{inFile}.{extension}'):
+        return AdoColumnarCorpus(inFile)
+    return AdoCorpus(inFile)
+
+
+'''
+    Read the texts of a shard of a columnar corpus (used by the processes of parallelTexts)
+'''
+
+
+def shardTexts(task):
+    (corpus, i, n, start, stop) = task
+    return corpus.texts(*corpus.shard(i, n, start, stop))
+
+
+'''
+    Read the texts of the documents from start to stop (excluded) of a columnar corpus with a pool of
+    processes, every one reading a shard
+'''
+
+
+def parallelTexts(corpus, workers, start=0, stop=None):
+    with Pool(workers) as pool:
+        return [text for texts in pool.map(shardTexts, [(corpus, i, workers, start, stop) for i in range(workers)])
+                for text in texts]
+
+
+'''
+    Convert a corpus from the pickle format to the columnar one
+'''
+
+
+def convertCorpus(inFile):
+    columnar = AdoColumnarCorpus(inFile)
+    n = 0
+    for document in AdoCorpus(inFile):
+        columnar.save(document)
+        n += 1
+    columnar.close()
+    # The documents are saved, hence their words are no longer needed
+    resetVocabulary()
+    return n
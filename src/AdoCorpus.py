@@ -23,17 +23,62 @@ class AdoCorpus:
         try:
             obj = pickle.load(self.handle)
             return AdoDocument(obj['id'], separator.join(obj['hashtags']),
-                           separator.join(obj['tokens']))
+                           separator.join(obj['tokens']), obj.get('count', 1))
         except EOFError:
             self.close
             raise StopIteration()
 
+    # Return the documents as saved, without building AdoDocuments (hence without adding words to the vocabulary)
+    def records(self):
+        with open(self.file, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    # Return the text of all the documents (read in sequence, whatever the n. of workers)
+    def texts(self, workers=1):
+        return [' '.join(r['tokens']) for r in self.records()]
+
+    # Return the count of all the documents (the n. of documents every one stands for)
+    def counts(self):
+        return [r.get('count', 1) for r in self.records()]
+
+    # Return the text and the count of all the documents, reading the file once (in sequence, whatever the n. of workers)
+    def textsAndCounts(self, workers=1):
+        (texts, counts) = ([], [])
+        for r in self.records():
+            texts.append(' '.join(r['tokens']))
+            counts.append(r.get('count', 1))
+        return (texts, counts)
+
+    # Return the text of the documents in batches of batch_size documents
+    def textBatches(self, batch_size):
+        for (texts, counts) in self.textAndCountBatches(batch_size):
+            yield texts
+
+    # Return the text and the count of the documents in batches of batch_size documents
+    def textAndCountBatches(self, batch_size):
+        (texts, counts) = ([], [])
+        for r in self.records():
+            texts.append(' '.join(r['tokens']))
+            counts.append(r.get('count', 1))
+            if len(texts) == batch_size:
+                yield (texts, counts)
+                (texts, counts) = ([], [])
+        if len(texts) > 0:
+            yield (texts, counts)
+
     def save(self, obj):
         if self.handle is None:
             self.handle = open(self.file, 'wb')
 
-        pickle.dump({'id': obj.id, 'hashtags': obj.hashtags, 'tokens': obj.tokens},
-                    self.handle, protocol=pickle.HIGHEST_PROTOCOL)
+        # Count is written only for documents that stand for duplicates as well
+        record = {'id': obj.id, 'hashtags': obj.hashtags, 'tokens': obj.tokens}
+        if obj.count != 1:
+            record['count'] = obj.count
+        pickle.dump(record, self.handle, protocol=pickle.HIGHEST_PROTOCOL)
 
     def close(self):
         if self.handle is not None:
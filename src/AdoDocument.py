@@ -1,49 +1,276 @@
-from nltk.corpus import stopwords
-from nltk import download
-from nltk.stem import PorterStemmer
-from nltk.tag import pos_tag
-import nltk
+from collections import OrderedDict
+from array import array
 import os
-
-nltk.download('averaged_perceptron_tagger')
-# Load stopwords and stemmers
-download('stopwords')
-engStopwords = set(stopwords.words('english'))
-stemmer = PorterStemmer()
-nltk.data.path.append(os.environ['NLTK_DIR'])
+import pickle
 
 separator = '|'
 
+# NLTK resources (and the packages they are downloaded from) needed to convert tokens to terms
+nltkResources = {'taggers/averaged_perceptron_tagger': 'averaged_perceptron_tagger', 'corpora/stopwords': 'stopwords'}
+
+# Stopwords and stemmer, loaded on first use by loadNLTK, so that reading documents does not import NLTK
+engStopwords = None
+stemmer = None
+
+
+# Load NLTK resources, looking for them in NLTK_DIR as well. Missing resources are downloaded, unless
+# NLTK_OFFLINE is true, in which case resources are looked for in NLTK_DIR only
+def loadNLTK():
+    global engStopwords, stemmer
+    if stemmer is not None:
+        return
+
+    import nltk
+    from nltk.corpus import stopwords
+    from nltk.stem import PorterStemmer
+
+    if str(os.environ.get('NLTK_OFFLINE')).lower() == 'true':
+        nltk.data.path = [os.environ['NLTK_DIR']]
+    elif os.environ.get('NLTK_DIR') is not None:
+        nltk.data.path.append(os.environ['NLTK_DIR'])
+
+    for (resource, package) in nltkResources.items():
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            if str(os.environ.get('NLTK_OFFLINE')).lower() == 'true':
+                raise
+            nltk.download(package, quiet=True)
+
+    engStopwords = set(stopwords.words('english'))
+    stemmer = PorterStemmer()
+
+'''
+    Vocabulary of the words of documents: every word is stored once, and documents hold the ids of their words
+    (and a reference to the vocabulary the ids are valid in)
+'''
+
+
+class Vocabulary:
+
+    def __init__(self):
+        self.index = {}  # Ids indexed by word
+        self.words = []  # Words indexed by id
+
+    # Return the ids of some words, adding the ones not in the vocabulary yet
+    def ids(self, words):
+        index = self.index
+        ids = array('I')
+        for w in words:
+            i = index.get(w)
+            if i is None:
+                i = index[w] = len(self.words)
+                self.words.append(w)
+            ids.append(i)
+        return ids
+
+    def lookup(self, ids):
+        words = self.words
+        return [words[i] for i in ids]
+
+
+# Vocabulary of the documents built from now on
+vocabulary = Vocabulary()
+
+
+# Start a new vocabulary for the documents built from now on, e.g. once a batch of documents is saved: the
+# previous one is kept by the documents built with it, and freed with the last of them
+def resetVocabulary():
+    global vocabulary
+    vocabulary = Vocabulary()
+
+
 '''
-    Holder class for a document in the corpus
+    Holder class for a document in the corpus. Hashtags and tokens are held as arrays of ids in the
+    vocabulary current when the document is built, and exposed as lists of strings; text (the tokens
+    joined by spaces) is built on access.
+    Count is the n. of documents this one stands for, when duplicates are collapsed into it
 '''
 
 
 class AdoDocument:
+    __slots__ = ('id', 'hashtag_ids', 'token_ids', '_text', 'count', 'vocabulary')
 
-    def __init__(self, id, hashtagsString, tokensString):
+    def __init__(self, id, hashtagsString, tokensString, count=1):
         self.id = id  # Document ID
-        self.hashtags = []  # List of hashtags
-        self.tokens = []  # List of words
-        self.text =''
+        self.count = count  # N. of documents this one stands for (duplicates collapsed into it included)
+        self.vocabulary = vocabulary  # Vocabulary the ids are valid in
+        self.hashtag_ids = array('I')  # Ids of hashtags
+        self.token_ids = array('I')  # Ids of words
+        self._text = None  # Text, if set explicitly (as ids, if set to a list of words)
         self.add(hashtagsString, tokensString)
 
     def add(self, hashtagsString, tokensString):
-        self.hashtags += self.__returnOnlyNotNull(hashtagsString)
-        self.tokens += self.__returnOnlyNotNull(tokensString)
-        self.text= ' '.join(self.tokens)
+        self.hashtag_ids.extend(self.vocabulary.ids(self.__returnOnlyNotNull(hashtagsString)))
+        self.token_ids.extend(self.vocabulary.ids(self.__returnOnlyNotNull(tokensString)))
+        self._text = None
+
+    @property
+    def hashtags(self):
+        return self.vocabulary.lookup(self.hashtag_ids)
+
+    @hashtags.setter
+    def hashtags(self, hashtags):
+        self.hashtag_ids = self.vocabulary.ids(hashtags)
+
+    @property
+    def tokens(self):
+        return self.vocabulary.lookup(self.token_ids)
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self.token_ids = self.vocabulary.ids(tokens)
+
+    @property
+    def text(self):
+        if self._text is None:
+            return ' '.join(self.tokens)
+        if isinstance(self._text, array):
+            return self.vocabulary.lookup(self._text)
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = self.vocabulary.ids(text) if isinstance(text, list) else text
+
+    # Documents are pickled as strings, since vocabulary ids are valid in this process only
+    def __getstate__(self):
+        return (self.id, self.hashtags, self.tokens, self._text if not isinstance(self._text, array) else self.text,
+                self.count)
+
+    def __setstate__(self, state):
+        (self.id, hashtags, tokens, text, self.count) = state
+        self.vocabulary = vocabulary
+        self.hashtag_ids = self.vocabulary.ids(hashtags)
+        self.token_ids = self.vocabulary.ids(tokens)
+        self.text = text
 
     def print(self):
         print(f'id:{self.id}\n hashtags:{separator.join(self.hashtags)}\n tokens:{separator.join(self.tokens)}')
 
-    # Convert tokens to terms by: removing non-nouns, non-alphabetic words, and stopwords, then stemming
+    # Convert tokens to terms (see taggedTokens2terms)
     def tokens2terms(self):
-        self.text= self.tokens
-        terms = [x[0] for x in pos_tag(self.tokens) if x[1][0:1] == 'N']
-        terms = [x for x in terms if x.isalpha()]
-        terms = [x for x in terms if x not in engStopwords]
-        terms = [stemmer.stem(x) for x in terms]
+        loadNLTK()
+        from nltk.tag import pos_tag
+        self.setTerms(taggedTokens2terms(pos_tag(self.tokens)))
+
+    # Replace tokens with the terms extracted from them
+    def setTerms(self, terms):
+        self._text = self.token_ids
         self.tokens = terms
 
     def __returnOnlyNotNull(self, s):
         return [t for t in s.split(separator) if len(t) > 0]
+
+
+'''
+    Bounded LRU cache of the term every noun token is converted to (None if the token is
+    non-alphabetic or a stopword), which can be saved and loaded back across runs
+'''
+
+
+class TermCache:
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.terms = OrderedDict()  # Terms indexed by token, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.added = None  # If not None, collects the terms added to the cache
+
+    def term(self, token):
+        try:
+            term = self.terms[token]
+            self.terms.move_to_end(token)
+            self.hits += 1
+            return term
+        except KeyError:
+            self.misses += 1
+
+        loadNLTK()
+        term = stemmer.stem(token) if token.isalpha() and token not in engStopwords else None
+        self.update({token: term})
+        if self.added is not None:
+            self.added[token] = term
+        return term
+
+    def update(self, terms):
+        for (token, term) in terms.items():
+            self.terms[token] = term
+            self.terms.move_to_end(token)
+        while len(self.terms) > self.max_size:
+            self.terms.popitem(last=False)
+
+    # Remove all the terms and reset the counts of hits and misses
+    def clear(self):
+        self.terms = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return f'{self.hits} hits, {self.misses} misses ({(self.hits / lookups if lookups > 0 else 0):.1%} hit rate), {len(self.terms)} terms'
+
+    # Load the cache, if the file exists and was saved with the same NLTK version
+    def load(self, cache_file):
+        import nltk
+        if not os.path.exists(cache_file):
+            return
+        with open(cache_file, 'rb') as f:
+            obj = pickle.load(f)
+        if obj['nltk_version'] == nltk.__version__:
+            self.update(obj['terms'])
+
+    def save(self, cache_file):
+        import nltk
+        with open(cache_file, 'wb') as f:
+            pickle.dump({'nltk_version': nltk.__version__, 'terms': dict(self.terms)}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
+termCache = TermCache()
+
+
+# Convert POS-tagged tokens to terms by: removing non-nouns, non-alphabetic words, and stopwords, then stemming
+def taggedTokens2terms(tagged):
+    terms = [termCache.term(x[0]) for x in tagged if x[1][0:1] == 'N']
+    return [x for x in terms if x is not None]
+
+
+# Convert many lists of tokens to lists of terms, tagging all of them with a single tagger
+def tokenLists2terms(token_lists):
+    loadNLTK()
+    from nltk.tag import pos_tag_sents
+    return [taggedTokens2terms(tagged) for tagged in pos_tag_sents(token_lists)]
+
+
+# Same as tokenLists2terms, but returns the terms added to the cache and the cache hits and misses as well,
+# so that a process can pass them back to its parent
+def tokenLists2termsTracked(token_lists):
+    termCache.added = {}
+    (hits, misses) = (termCache.hits, termCache.misses)
+    terms = tokenLists2terms(token_lists)
+    return (terms, termCache.added, termCache.hits - hits, termCache.misses - misses)
+
+
+# Convert tokens to terms for a list of documents, in batches of batch_size documents that are
+# spread over a pool of processes (if given). Terms are the same tokens2terms would extract
+def extractTerms(documents, batch_size=1000, pool=None):
+    batches = [documents[i:i + batch_size] for i in range(0, len(documents), batch_size)]
+    token_lists = ([d.tokens for d in batch] for batch in batches)
+    if pool is not None:
+        results = pool.imap(tokenLists2termsTracked, token_lists)
+    else:
+        results = map(tokenLists2terms, token_lists)
+
+    for (batch, result) in zip(batches, results):
+        if pool is not None:
+            # Merges the terms computed by the process into the cache of this one
+            (terms, added, hits, misses) = result
+            termCache.update(added)
+            termCache.hits += hits
+            termCache.misses += misses
+        else:
+            terms = result
+        for (d, t) in zip(batch, terms):
+            d.setTerms(t)
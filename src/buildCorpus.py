@@ -1,5 +1,6 @@
 '''
-    Load, transform and serialize a corpus (a CouchdDB view JSON) in pickle format.
+    Load, transform and serialize a corpus (a CouchdDB view JSON) in pickle format (or in the
+    columnar format of AdoColumnarCorpus).
     The corpus is written as a dictionary, indexed by conversation IDs, with a dictionary as value
     ('hashtags' key for the list of hashtags, and 'tokens' for the list of tweet words)
 '''
@@ -9,83 +10,499 @@ import sys
 sys.path.append('../src')
 
 from logger import logger
-from AdoDocument import AdoDocument
+from AdoDocument import AdoDocument, separator, extractTerms, termCache, loadNLTK, resetVocabulary
 from AdoCorpus import AdoCorpus
-import json_stream, configargparse
+from AdoColumnarCorpus import AdoColumnarCorpus
+from metrics_lib import metrics, addMetricsArguments
+from rows_lib import rowBatches, filterRows
+from dedup_lib import Deduplicator
+import configargparse, glob, heapq, itertools, pickle, queue, tempfile, os
+from multiprocessing import Pool
+from tqdm import tqdm
+
+# Approximate memory used by every conversation buffered by streamDocuments, besides its strings
+CONVERSATION_OVERHEAD = 200
+
+# Approximate ratio of the memory used by retrieveDocuments to the size of the query file
+FILE_MEMORY_FACTOR = 4
 
 '''
     Retrieve documents from CouchDB, extract terms and return a dictionary 
-    indexed by conversation_id 
+    indexed by conversation_id. Terms are extracted in batches of term_batch_size documents,
+    spread over workers processes. If a deduplicator is given, duplicate documents are collapsed
+    into one (see extractUniqueTerms)
 '''
 
 
-def retrieveDocuments(corpus_query_file, tm_mintokens_perdocument, corpus_useconversation):
+def retrieveDocuments(corpus_query_file, tm_mintokens_perdocument, corpus_useconversation,
+                      workers=1, term_batch_size=1000, parser_backend='auto', row_batch_size=10000,
+                      deduplicator=None):
     documents = {}
     try:
         logger.warning(f'Discarding documents with fewer than {tm_mintokens_perdocument} tokens')
         logger.warning(f'Using conversation: {corpus_useconversation}')
         logger.warning(f'Started reading from query file {corpus_query_file}')
 
-        with open(corpus_query_file, 'r') as f:
-            rows = json_stream.load(f, persistent=False)['rows']
+        with metrics.stage('json_parse') as stage:
+            stage.items = 0
+            for batch in rowBatches(corpus_query_file, row_batch_size, parser_backend):
+                stage.items += len(batch)
 
-            for row in rows.persistent():
+                # If the number of tokens in the document is below a threshold, discard the document
+                for (k, tags, tokens) in filterRows(batch, tm_mintokens_perdocument):
 
-                k = row['key']
-                v = row['value']
+                    # If documents has to be a part of a conversation
+                    if str(corpus_useconversation).lower() == 'true':
 
-                # If the number of tokens in the document is below a threshold, discard the document
-                if len(v['tokens']) < tm_mintokens_perdocument:
-                    continue
+                        # If the document is already present in documents, merges its text
+                        # with the one already present
+                        if documents.get(k[3]):
+                            documents[k[3]].add(tags, tokens)
+                        else:
+                            documents[k[3]] = AdoDocument(k[3], tags, tokens)
+
+                    # If the document has to be stored as a single
+                    else:
+                        documents[f'{k[3]}-{k[4]}'] = AdoDocument(f'{k[3]}', tags, tokens)
+
+    except MemoryError:
+        logger.error(f'Memory exception')
+        sys.exit(1)
+
+    logger.warning(f'started converting tokens to terms')
+    if workers > 1:
+        # NLTK resources are loaded before forking, so that processes do not load them again
+        loadNLTK()
+        with Pool(workers) as pool:
+            kept = extractUniqueTerms(list(documents.values()), term_batch_size, pool, deduplicator)
+    else:
+        kept = extractUniqueTerms(list(documents.values()), term_batch_size, None, deduplicator)
+    if deduplicator is not None:
+        kept = set(id(d) for d in kept)
+        documents = {k: d for (k, d) in documents.items() if id(d) in kept}
+    return documents
+
+
+def extractUniqueTerms(documents, term_batch_size, pool=None, deduplicator=None):
+    '''
+        Extract the terms of documents, collapsing duplicates first if a deduplicator is given: documents
+        with the same tokens are collapsed before extracting terms (which is then done once for all of
+        them), documents with near-identical terms after
+
+                Parameters:
+                        documents (List(AdoDocument)): documents
+                        term_batch_size (int): n. of documents every process extracts terms from at once
+                        pool (Pool): processes extracting terms (None to extract them in this process)
+                        deduplicator (Deduplicator): deduplicator, or None not to collapse duplicates
+
+                Returns:
+                        List(AdoDocument): documents kept, whose count includes the duplicates collapsed into them
+    '''
+    n = len(documents)
+    if deduplicator is not None:
+        with metrics.stage('dedup', n):
+            documents = deduplicator.exact(documents)
+    with metrics.stage('term_extraction', len(documents)):
+        extractTerms(documents, term_batch_size, pool)
+    if deduplicator is not None:
+        with metrics.stage('dedup'):
+            documents = deduplicator.near(documents)
+        logger.warning(f'Collapsed {n - len(documents)} duplicate documents out of {n}')
+    return documents
+
+
+'''
+    Write a run of buffered conversations, sorted by conversation ID, to a spill file
+'''
+
+
+def spillConversations(conversations, spill_dir):
+    with tempfile.NamedTemporaryFile(mode='wb', dir=spill_dir, prefix='adocorpus-', suffix='.spill',
+                                      delete=False) as f:
+        for k in sorted(conversations):
+            pickle.dump((k, separator.join(conversations[k][0]), separator.join(conversations[k][1])),
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        return f.name
+
+
+'''
+    Read back the (conversation ID, hashtags, tokens) tuples of a spill file
+'''
+
+
+def readSpill(spill_file):
+    with open(spill_file, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+'''
+    Retrieve documents from a CouchDB view JSON and yield them as soon as they are complete, 
+    without holding the whole corpus in memory.
+    When documents are conversations and the input is sorted by key, a conversation is complete
+    when the next one starts; otherwise conversations are buffered up to memory_budget (MB),
+    then spilled to disk in runs sorted by conversation ID, which are merged at the end
+'''
+
+
+def documentId(key):
+    # ID of a buffered document: the conversation ID, first element of the key of single documents
+    return key[0] if isinstance(key, tuple) else key
+
+
+def streamDocuments(corpus_query_file, tm_mintokens_perdocument, corpus_useconversation,
+                    corpus_sorted=False, memory_budget=1024, spill_dir=None, parser_backend='auto',
+                    row_batch_size=10000):
+    logger.warning(f'Discarding documents with fewer than {tm_mintokens_perdocument} tokens')
+    logger.warning(f'Using conversation: {corpus_useconversation}')
+    logger.warning(f'Started streaming from query file {corpus_query_file}')
+    use_conversation = str(corpus_useconversation).lower() == 'true'
+    sorted_input = str(corpus_sorted).lower() == 'true'
+
+    # Hashtags and tokens strings of the buffered conversations, indexed by conversation ID (or, if documents
+    # are single, by conversation ID and the key after it, a later row replacing an earlier one with the same
+    # key, as retrieveDocuments does)
+    conversations = {}
+    conversations_size = 0
+    spill_files = []
+    document = None
+    document_key = None
+
+    try:
+        for batch in rowBatches(corpus_query_file, row_batch_size, parser_backend):
+
+            # If the number of tokens in the document is below a threshold, discard the document
+            for (k, tags, tokens) in filterRows(batch, tm_mintokens_perdocument):
 
-                # If documents has to be a part of a conversation
-                if str(corpus_useconversation).lower() == 'true':
+                key = k[3] if use_conversation else (f'{k[3]}', k[4])
 
-                    # If the document is already present in documents, merges its text
-                    # with the one already present
-                    if documents.get(k[3]):
-                        documents[k[3]].add(v['tags'], v['tokens'])
+                # If the input is sorted, the previous document is complete when a new one starts
+                if sorted_input:
+                    if document is not None and document_key == key:
+                        if use_conversation:
+                            document.add(tags, tokens)
+                        else:
+                            document = AdoDocument(documentId(key), tags, tokens)
                     else:
-                        documents[k[3]] = AdoDocument(k[3], v['tags'], v['tokens'])
+                        if document is not None:
+                            yield document
+                        document = AdoDocument(documentId(key), tags, tokens)
+                        document_key = key
 
-                # If the document has to be stored as a single
+                # Otherwise the document is buffered, and spilled to disk when the buffer is full
                 else:
-                    documents[f'{k[3]}-{k[4]}'] = AdoDocument(f'{k[3]}', v['tags'], v['tokens'])
+                    if key not in conversations:
+                        conversations[key] = ([], [])
+                        conversations_size += CONVERSATION_OVERHEAD
+                    elif not use_conversation:
+                        conversations_size -= len(conversations[key][0][0]) + len(conversations[key][1][0])
+                        conversations[key] = ([], [])
+                    conversations[key][0].append(tags)
+                    conversations[key][1].append(tokens)
+                    conversations_size += len(tags) + len(tokens)
+
+                    if conversations_size > memory_budget * 1024 * 1024:
+                        spill_files.append(spillConversations(conversations, spill_dir))
+                        logger.warning(f'Spilled {len(conversations)} conversations to {spill_files[-1]}')
+                        conversations = {}
+                        conversations_size = 0
+
+        if document is not None:
+            yield document
+
+        # If nothing was spilled, the conversations are all in the buffer
+        if len(spill_files) == 0:
+            for k in conversations:
+                yield AdoDocument(documentId(k), separator.join(conversations[k][0]),
+                                  separator.join(conversations[k][1]))
+            return
+
+        if len(conversations) > 0:
+            spill_files.append(spillConversations(conversations, spill_dir))
+            conversations = {}
+
+        # Merges the runs, which are sorted by conversation ID; parts of the same conversation
+        # are merged in the order they were read (single documents are replaced by the last part)
+        logger.warning(f'Merging {len(spill_files)} spill files')
+        merged = heapq.merge(*[readSpill(spill_file) for spill_file in spill_files], key=lambda c: c[0])
+        for (k, parts) in itertools.groupby(merged, key=lambda c: c[0]):
+            parts = list(parts) if use_conversation else [list(parts)[-1]]
+            yield AdoDocument(documentId(k), separator.join([p[1] for p in parts]),
+                              separator.join([p[2] for p in parts]))
 
     except MemoryError:
         logger.error(f'Memory exception')
         sys.exit(1)
 
-    logger.warning(f'started converting tokens to terms')
-    {documents[k].tokens2terms() for k in documents}
-    return documents
+    finally:
+        for spill_file in spill_files:
+            os.remove(spill_file)
+
+
+def ingestFile(corpus_query_file, corpus_path, settings, workers):
+    '''
+        Build the corpus of a query file
+
+                Parameters:
+                        corpus_query_file (String): input query file
+                        corpus_path (String): output corpus file (minus the extension)
+                        settings (Namespace): settings of the script
+                        workers (int): n. of processes extracting terms
+
+                Returns:
+                        int: n. of documents of the corpus
+    '''
+    if settings.corpus_format == 'columnar':
+        corpus = AdoColumnarCorpus(corpus_path)
+    else:
+        corpus = AdoCorpus(corpus_path)
+
+    if str(settings.corpus_streaming).lower() == 'true':
+        if workers > 1:
+            loadNLTK()
+        pool = Pool(workers) if workers > 1 else None
+        n = 0
+        batch = []
+
+        # Terms are extracted from enough documents to keep every worker busy with one batch
+        # Duplicates are collapsed within a batch only, since documents of previous batches are saved already.
+        # A new vocabulary is started once a batch is saved, so that the words of a batch are freed with its
+        # documents
+        def saveBatch():
+            kept = extractUniqueTerms(batch, settings.term_batch_size, pool, deduplicator(settings))
+            with metrics.stage('corpus_write', len(kept)):
+                [corpus.save(v) for v in kept]
+            batch.clear()
+            resetVocabulary()
+
+        # Documents are parsed from the input file as they are consumed, hence this stage includes the others
+        with metrics.stage('corpus_streaming') as stage:
+            for document in streamDocuments(corpus_query_file, settings.tm_mintokens_perdocument,
+                                             settings.corpus_useconversation, settings.corpus_sorted,
+                                             settings.corpus_memory_budget, settings.spill_dir,
+                                             settings.parser_backend, settings.row_batch_size):
+                batch.append(document)
+                n += 1
+                if len(batch) >= settings.term_batch_size * workers:
+                    saveBatch()
+            saveBatch()
+            stage.items = n
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        logger.warning(f'Streamed {n} documents')
+    else:
+        documents = retrieveDocuments(corpus_query_file, settings.tm_mintokens_perdocument,
+                                      settings.corpus_useconversation, workers,
+                                      settings.term_batch_size, settings.parser_backend, settings.row_batch_size,
+                                      deduplicator(settings))
+        n = len(documents)
+        with metrics.stage('corpus_write', n):
+            [corpus.save(v) for v in documents.values()]
+
+    with metrics.stage('corpus_write'):
+        corpus.close()
+    logger.warning(f'Saved corpus to {corpus.file}')
+    # The words of the documents of this file are not needed by the next ones
+    resetVocabulary()
+    return n
+
+
+def deduplicator(settings):
+    # Deduplicator of documents, if duplicates are to be collapsed
+    if str(settings.dedup).lower() == 'true':
+        return Deduplicator(settings.dedup_threshold)
+    return None
+
+
+def inputFiles(corpus_query_file):
+    '''
+        Return the query files to ingest
+
+                Parameters:
+                        corpus_query_file (String): query file, directory of query files (*.json), or glob pattern
+
+                Returns:
+                        List(String): query files, sorted by name
+    '''
+    if os.path.isdir(corpus_query_file):
+        return sorted(glob.glob(f'{corpus_query_file}/*.json'))
+    if glob.has_magic(corpus_query_file):
+        return sorted(glob.glob(corpus_query_file))
+    return [corpus_query_file]
+
+
+# Extension of the corpus files written with the settings of the script
+def corpusExtension(settings):
+    return AdoColumnarCorpus('').file[1:] if settings.corpus_format == 'columnar' else AdoCorpus('').file[1:]
+
+
+def ingestFileTask(task):
+    '''
+        Build the corpus of a query file in a process of ingestFiles, collecting the terms added to
+        the term cache and the metrics of the process, to pass them back to the parent
+
+                Parameters:
+                        task (Tuple): query file, output corpus file (minus the extension) and settings
+
+                Returns:
+                        (String, int, Dict, int, int, Dict): query file, n. of documents, terms added to the cache,
+                            cache hits, cache misses and metrics of stages
+    '''
+    (corpus_query_file, corpus_path, settings) = task
+    termCache.added = {}
+    metrics.stages = {}
+    (hits, misses) = (termCache.hits, termCache.misses)
+
+    # Processes of a pool cannot start pools of their own
+    n = ingestFile(corpus_query_file, corpus_path, settings, 1)
+    return (corpus_query_file, n, termCache.added, termCache.hits - hits, termCache.misses - misses, metrics.stages)
+
+
+def fileMemory(corpus_query_file, settings):
+    # Approximate memory (MB) used to build the corpus of a query file
+    if str(settings.corpus_streaming).lower() == 'true':
+        return settings.corpus_memory_budget
+    return FILE_MEMORY_FACTOR * os.path.getsize(corpus_query_file) / (1 << 20)
+
+
+def ingestFiles(query_files, settings):
+    '''
+        Build the corpora of many query files, with a pool of file_workers processes. Files whose corpus
+        is newer than them are skipped; files are started as long as the approximate memory of the
+        files being processed stays within file_memory_limit MB (one file at least is always processed)
+
+                Parameters:
+                        query_files (List(String)): input query files
+                        settings (Namespace): settings of the script
+    '''
+    tasks = []
+    for corpus_query_file in query_files:
+        corpus_path = f'{settings.corpora_dir}/{os.path.basename(corpus_query_file)}.corpus'
+        corpus_out = f'{corpus_path}.{corpusExtension(settings)}'
+        if str(settings.overwrite).lower() != 'true' and os.path.exists(corpus_out) \
+                and os.path.getmtime(corpus_out) >= os.path.getmtime(corpus_query_file):
+            logger.warning(f'Skipping {corpus_query_file}, {corpus_out} is up-to-date')
+            continue
+        tasks.append((corpus_query_file, corpus_path, settings))
+    logger.warning(f'Ingesting {len(tasks)} files out of {len(query_files)} with {settings.file_workers} processes')
+    if len(tasks) == 0:
+        return
+
+    # NLTK resources are loaded before forking, so that processes do not load them again
+    loadNLTK()
+    done = queue.Queue()
+    running = {}
+    n_documents = 0
+    with Pool(settings.file_workers, maxtasksperchild=1) as pool, tqdm(total=len(tasks), unit='file') as progress:
+        while len(tasks) > 0 or len(running) > 0:
+            while len(tasks) > 0 and len(running) < settings.file_workers and \
+                    (len(running) == 0 or settings.file_memory_limit <= 0 or
+                     sum(running.values()) + fileMemory(tasks[0][0], settings) <= settings.file_memory_limit):
+                task = tasks.pop(0)
+                running[task[0]] = fileMemory(task[0], settings)
+                pool.apply_async(ingestFileTask, (task,), callback=done.put, error_callback=done.put)
+
+            result = done.get()
+            if isinstance(result, BaseException):
+                raise result
+            (corpus_query_file, n, added, hits, misses, stages) = result
+            del running[corpus_query_file]
+
+            # Merges the terms and metrics of the process into the ones of this one
+            termCache.update(added)
+            termCache.hits += hits
+            termCache.misses += misses
+            metrics.merge(stages)
+            n_documents += n
+            progress.update(1)
+            progress.set_postfix(documents=n_documents)
+            logger.warning(f'Ingested {corpus_query_file}: {n} documents')
 
 
 def main():
     argp = configargparse.ArgParser()
     argp.add('--corpus_query_file', required=True, type=str, env_var='CORPUS_QUERY_FILE',
-             help='input corpus file name (minus the extension)')
-    argp.add('--corpus_file', required=True, type=str, env_var='CORPUS_FILE',
-             help='output corpus file')
+             help='input query file, directory of query files (*.json), or glob pattern (quoted) of query files')
+    argp.add('--corpus_file', required=False, type=str, env_var='CORPUS_FILE',
+             help='output corpus file (for a single query file, defaults to the query file name plus ".corpus"; '
+                  'corpora of many query files are always named this way)')
     argp.add('--corpora_dir', required=False, type=str, env_var='CORPORA_DIR',
              help='directory holding output corpus')
+    argp.add('--corpus_format', required=False, type=str, default='pickle', choices=['pickle', 'columnar'],
+             env_var='CORPUS_FORMAT',
+             help='output corpus format: pickle, or columnar (indexed and memory-mappable)')
     argp.add('--tm_mintokens_perdocument', required=False, type=int, env_var='TM_MINTOKENS_PERDOCUMENT',
              help='minimum number of tokens to retain a document in the corpus')
     argp.add('--corpus_useconversation', required=False, type=bool, env_var='CORPUS_USECONVERSATION',
              help='flag to use conversations in grouping input documents')
+    argp.add('--parser_backend', required=False, type=str, default='auto', choices=['auto', 'ijson', 'json_stream'],
+             env_var='PARSER_BACKEND',
+             help='parser of the query file: ijson, json_stream, or auto (ijson if its C backend is installed)')
+    argp.add('--row_batch_size', required=False, type=int, default=10000, env_var='ROW_BATCH_SIZE',
+             help='n. of rows of the query file parsed at once')
+    argp.add('--corpus_streaming', required=False, type=str, default='false', env_var='CORPUS_STREAMING',
+             help='flag to extract terms and save documents as soon as they are complete, with bounded memory')
+    argp.add('--corpus_sorted', required=False, type=str, default='false', env_var='CORPUS_SORTED',
+             help='flag stating that the input rows of every conversation are contiguous (streaming only)')
+    argp.add('--corpus_memory_budget', required=False, type=int, default=1024, env_var='CORPUS_MEMORY_BUDGET',
+             help='MB of conversations to buffer before spilling them to disk (streaming only)')
+    argp.add('--spill_dir', required=False, type=str, env_var='SPILL_DIR',
+             help='directory holding temporary spill files (streaming only, defaults to the system temporary directory)')
+    argp.add('--dedup', required=False, type=str, default='false', env_var='DEDUP',
+             help='flag to collapse duplicate and near-duplicate documents (e.g. retweets) into one document, '
+                  'counting the documents it stands for (when streaming, within batches of term_batch_size * '
+                  'workers documents only)')
+    argp.add('--dedup_threshold', required=False, type=float, default=0.8, env_var='DEDUP_THRESHOLD',
+             help='minimum Jaccard similarity of the terms of near-duplicate documents')
+    argp.add('--workers', required=False, type=int, default=1, env_var='N_WORKERS',
+             help='n. of processes extracting terms')
+    argp.add('--term_batch_size', required=False, type=int, default=1000, env_var='TERM_BATCH_SIZE',
+             help='n. of documents every process extracts terms from at once')
+    argp.add('--term_cache_size', required=False, type=int, default=100000, env_var='TERM_CACHE_SIZE',
+             help='maximum n. of tokens whose term is cached')
+    argp.add('--term_cache_file', required=False, type=str, env_var='TERM_CACHE_FILE',
+             help='file the term cache is loaded from and saved to across runs (e.g. in NLTK_DIR or corpora_dir)')
+    argp.add('--file_workers', required=False, type=int, default=1, env_var='N_FILE_WORKERS',
+             help='n. of processes building the corpora of many query files at once (every one uses one process to '
+                  'extract terms)')
+    argp.add('--file_memory_limit', required=False, type=int, default=0, env_var='FILE_MEMORY_LIMIT',
+             help='approximate MB of memory the processes building corpora of many query files can use (0 for no limit)')
+    argp.add('--overwrite', required=False, type=str, default='false', env_var='OVERWRITE',
+             help='flag to build the corpora of many query files even if they are newer than the query files')
+    addMetricsArguments(argp)
 
     settings = argp.parse_known_args()[0]
+    metrics.configure(settings)
+
+    termCache.max_size = settings.term_cache_size
+    if settings.term_cache_file is not None:
+        termCache.load(settings.term_cache_file)
+        logger.warning(f'Loaded {len(termCache.terms)} terms from {settings.term_cache_file}')
 
-    documents = retrieveDocuments(settings.corpus_query_file, settings.tm_mintokens_perdocument,
-                                  settings.corpus_useconversation)
+    query_files = inputFiles(settings.corpus_query_file)
+    if query_files == [settings.corpus_query_file]:
+        corpus_file = settings.corpus_file if settings.corpus_file is not None \
+            else f'{os.path.basename(settings.corpus_query_file)}.corpus'
+        ingestFile(settings.corpus_query_file, f'{settings.corpora_dir}/{corpus_file}', settings, settings.workers)
+    else:
+        if settings.corpus_file is not None:
+            logger.warning(f'Ignoring corpus_file, corpora are named after query files')
+        ingestFiles(query_files, settings)
 
-    corpus = AdoCorpus(f'{settings.corpora_dir}/{settings.corpus_file}')
-    [corpus.save(v) for v in documents.values()]
-    logger.warning(f'Saved corpus to {settings.corpora_dir}/{settings.corpus_file}.pickle')
+    logger.warning(f'Term cache: {termCache.stats()}')
+    if settings.term_cache_file is not None:
+        termCache.save(settings.term_cache_file)
+        logger.warning(f'Saved term cache to {settings.term_cache_file}')
 
 
 if __name__ == '__main__':
     # WARNING log level is used to avoid gensim printing out very verbose logs at INFO level
     logger.warning(f'Started {__file__}')
     main()
+    metrics.write()
     logger.warning(f'ended')
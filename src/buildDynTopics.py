@@ -1,12 +1,13 @@
-import numpy as np, configargparse, glob, os, sys
+import numpy as np, configargparse, glob, json, os, sys
+from collections import Counter
 
 sys.path.append('../src')
 
-from AdoCorpus import AdoCorpus
+from AdoColumnarCorpus import openCorpus
 from logger import logger
-from bertopic import BERTopic
-from sklearn.metrics.pairwise import cosine_similarity
-from export_lib import exportTopicLocationToGeoJSON
+from export_lib import exportTopicLocationToGeoJSON, exportTopicLocationToNpz
+from embedding_lib import corpusEmbeddings
+from metrics_lib import metrics, addMetricsArguments
 from tuples import TopicLocation
 
 """
@@ -15,84 +16,406 @@ from tuples import TopicLocation
 """
 
 
-def buildTopics(corpus_in, timestamps_in, bert_top_n_words, bert_min_topic_size, sample_fraction):
+def sampleEmbeddings(embeddings_in, indices):
+    '''
+        Gather the embeddings of some documents from the embeddings of every corpus file
+
+                Parameters:
+                        embeddings_in (List(numpy.array)): embeddings of every corpus file
+                        indices (List(int)): indices of the documents in the whole corpus
+
+                Returns:
+                        numpy.array: embeddings of the documents
+    '''
+    offsets = np.cumsum([0] + [len(e) for e in embeddings_in])
+    indices = np.array(indices, dtype=np.int64)
+    files = np.searchsorted(offsets, indices, side='right') - 1
+    embeddings = np.zeros([len(indices), embeddings_in[0].shape[1]], dtype=np.float32)
+    for f in np.unique(files):
+        embeddings[files == f] = embeddings_in[f][indices[files == f] - offsets[f]]
+    return embeddings
+
+
+def topicLocations(topic_model, topics_over_time, timestamps, y_unit=None):
+    '''
+        Place topics in the topic space: every timestamp is a column, and topics are ordered along
+        the column according to the leaves of the topic hierarchy, spaced by their distance
+
+                Parameters:
+                        topic_model (BERTopic): fitted topic model
+                        topics_over_time (pandas.DataFrame): frequency of every topic at the timestamps to
+                            place topics at
+                        timestamps (List(int)): timestamps of the documents (of all the columns)
+                        y_unit (float): distance of topics that is one unit of Y, or None to make the sum of
+                            the distances of consecutive topics in the hierarchy as many units as columns
+
+                Returns:
+                        (List(TopicLocation), float): locations of topics and the unit of Y they are placed with
+    '''
+    with metrics.stage('layout', len(topics_over_time)):
+        return layoutTopics(topic_model, topics_over_time, timestamps, y_unit)
+
+
+# Lay out topics, see topicLocations
+def layoutTopics(topic_model, topics_over_time, timestamps, y_unit=None):
+    import pandas as pd
+    from sklearn.metrics.pairwise import cosine_similarity
+    from scipy.cluster.hierarchy import linkage, leaves_list
+    from scipy.spatial.distance import pdist
+
+    freq_df = topic_model.get_topic_freq()
+    freq_df = freq_df.loc[freq_df.Topic != -1, :]
+    topics = np.array(sorted(freq_df.Topic.to_list()))
+    embeddings = np.array(topic_model.topic_embeddings)[
+        np.array([sorted(list(topic_model.get_topics().keys())).index(topic) for topic in topics])]
+    dist_matrix = 1 - cosine_similarity(embeddings)
+
+    # Topics (as positions in dist_matrix) ordered as the leaves of the topic hierarchy, top to bottom
+    if len(topics) > 1:
+        leaves = leaves_list(linkage(pdist(dist_matrix), 'ward'))[::-1]
+    else:
+        leaves = np.arange(len(topics))
+    ytot = dist_matrix[leaves[:-1], leaves[1:]].sum()
+    rank = np.full(topics.max() + 1 if len(topics) > 0 else 0, -1)
+    rank[topics[leaves]] = np.arange(len(leaves))
+
+    # Rows of the topics in the hierarchy, ordered by timestamp and leaf: along every column topics are
+    # spaced by the distance from the previous (non-empty) topic
+    tot = topics_over_time.set_index(['Timestamp', 'Topic'])
+    tot = tot.loc[tot.index.get_level_values('Topic').isin(topics), ['Frequency']]
+    tot['rank'] = rank[tot.index.get_level_values('Topic')]
+    tot = tot.sort_values(['Timestamp', 'rank'], kind='stable')
+    pos = leaves[tot['rank'].to_numpy()]
+    first = np.r_[True, tot.index.get_level_values('Timestamp')[1:] != tot.index.get_level_values('Timestamp')[:-1]]
+    step = np.where(first, 0.0, dist_matrix[np.r_[pos[:1], pos[:-1]], pos])
+    ycum = pd.Series(step, index=tot.index).groupby(level='Timestamp').cumsum().to_numpy()
+
+    columns = {t: col for (col, t) in enumerate(sorted(set(timestamps)))}
+    if y_unit is None:
+        y_unit = ytot / len(columns)
+    terms = {topic: topic_model.get_topic(topic) for topic in topics[leaves].tolist()}
+    locs = [
+        TopicLocation(
+            x=columns[t],
+            y=y / y_unit,
+            t=t,
+            id=topic,
+            n=n,
+            label=','.join([w[0] for w in terms[topic][0:5]]),
+            top_terms=terms[topic]
+        )
+        for ((t, topic), n, y) in zip(tot.index.tolist(), tot['Frequency'].tolist(), ycum.tolist())
+        if t in columns
+    ]
+
+    logger.warning('Done computing locations')
+    return (locs, y_unit)
+
+
+def buildTopics(corpus_in, timestamps_in, bert_top_n_words, bert_min_topic_size, sample_fraction,
+                embeddings_in=None, embedding_model=None, counts_in=None):
+    # Imported here, since it takes long to load
+    from bertopic import BERTopic
+
     logger.warning(f'Corpus size: {len(corpus_in)}')
     corpus = []
     timestamps = []
+    indices = []
+    counts = []
     for i in range(len(corpus_in)):
         if i % sample_fraction == 0:
             corpus.append(corpus_in[i])
             timestamps.append(timestamps_in[i])
+            indices.append(i)
+            counts.append(counts_in[i] if counts_in is not None else 1)
     logger.warning(f'Sampled corpus size: {len(corpus)}')
 
-    topic_model = BERTopic(top_n_words=bert_top_n_words, min_topic_size=bert_min_topic_size)
-    (doc_to_topic, doc_to_topic_prob) = topic_model.fit_transform(corpus)
-    topics_over_time = topic_model.topics_over_time(corpus, doc_to_topic, timestamps)
+    topic_model = BERTopic(top_n_words=bert_top_n_words, min_topic_size=bert_min_topic_size,
+                           embedding_model=embedding_model)
+    # Without cached embeddings, documents are embedded by the model, hence clustering includes embedding
+    with metrics.stage('clustering', len(corpus)):
+        if embeddings_in is not None:
+            (doc_to_topic, doc_to_topic_prob) = topic_model.fit_transform(
+                corpus, embeddings=sampleEmbeddings(embeddings_in, indices))
+        else:
+            (doc_to_topic, doc_to_topic_prob) = topic_model.fit_transform(corpus)
+    with metrics.stage('topics_over_time', len(corpus)):
+        topics_over_time = topic_model.topics_over_time(corpus, doc_to_topic, timestamps)
+        if any(c != 1 for c in counts):
+            topics_over_time = weightFrequencies(topics_over_time, doc_to_topic, timestamps, counts)
 
     logger.warning('Done computing topics')
+    return topicLocations(topic_model, topics_over_time, timestamps) + (topic_model, topics_over_time)
 
-    freq_df = topic_model.get_topic_freq()
-    freq_df = freq_df.loc[freq_df.Topic != -1, :]
-    topics = sorted(freq_df.Topic.to_list())
-    embeddings = np.array(topic_model.topic_embeddings)[
-        np.array([sorted(list(topic_model.get_topics().keys())).index(topic) for topic in topics])]
-    dist_matrix = 1 - cosine_similarity(embeddings)
-    locs = []
-    col = 0
-
-    fig = topic_model.visualize_hierarchy()
-    leaves = []
-
-    for tt in fig.layout.yaxis.ticktext:
-        if len(tt) > 0:
-            leaves.append(int(tt.split('_')[0]))
-    leaves.reverse()
-
-    ytot = 0.0
-    old_leaf = -1
-    for leaf in leaves:
-        if old_leaf != -1:
-            ytot += dist_matrix[old_leaf][leaf]
-        old_leaf = leaf
-
-    for t in set(timestamps):
-        tt = topics_over_time[topics_over_time['Timestamp'] == t]
-        row = 0
-        ycum = 0.0
-        old_leaf = -1
-
-        for leaf in leaves:
-
-            #  if the topics is "misc", skips
-            if leaf == -1:
-                continue
-
-            r = tt[tt['Topic'] == leaf]
-
-            # If the topic is empty, skips
-            if r.empty == True:
-                continue
-
-            if old_leaf != -1:
-                ycum += dist_matrix[old_leaf][leaf]
-
-            locs.append(
-                TopicLocation(
-                    x=col,
-                    y=(ycum / ytot) * len(set(timestamps)),
-                    t=t,
-                    id=leaf,
-                    n=r['Frequency'].item(),
-                    label=','.join([w[0] for w in topic_model.get_topic(leaf)[0:5]]),
-                    top_terms=topic_model.get_topic(leaf)
-                )
-            )
-            row += 1
-            old_leaf = leaf
-        col += 1
 
-    logger.warning('Done computing locations')
-    return locs
+def weightFrequencies(topics_over_time, doc_to_topic, timestamps, counts):
+    '''
+        Replace the frequency of every topic at every timestamp with the sum of the counts of its
+        documents, so that documents standing for collapsed duplicates are counted as many times
+
+                Parameters:
+                        topics_over_time (pandas.DataFrame): frequency of every topic at every timestamp
+                        doc_to_topic (List(int)): topic of every document
+                        timestamps (List(int)): timestamp of every document
+                        counts (List(int)): count of every document
+
+                Returns:
+                        pandas.DataFrame: topics_over_time, with weighted frequencies
+    '''
+    import pandas as pd
+
+    weights = pd.DataFrame({'Topic': doc_to_topic, 'Timestamp': timestamps, 'Frequency': counts}) \
+        .groupby(['Topic', 'Timestamp'])['Frequency'].sum()
+    topics_over_time = topics_over_time.copy()
+    topics_over_time['Frequency'] = weights.reindex(
+        pd.MultiIndex.from_frame(topics_over_time[['Topic', 'Timestamp']])).to_numpy()
+    return topics_over_time
+
+
+def buildTopicsAssignAll(corpora_files, bert_top_n_words, bert_min_topic_size, sample_fraction, batch_size,
+                         embedding_model=None, embedding_dtype=None, embedding_cache=False, read_workers=1):
+    '''
+        Fit a topic model on a sample of every time slice, then assign every document of every
+        time slice to a topic, reading batch_size documents at a time, so that topic frequencies
+        are computed over the whole corpus
+
+                Parameters:
+                        corpora_files (List(String)): corpus files (minus the extension), one per time slice
+                        bert_top_n_words (int): number of term returned per cluster
+                        bert_min_topic_size (int): minimum number of documents to have for a cluster
+                        sample_fraction (int): one document out of sample_fraction of every time slice is
+                            used to fit the model
+                        batch_size (int): n. of documents assigned to topics at once
+                        embedding_model (String): sentence-transformers model used to embed documents
+                        embedding_dtype (String): type of the cached embeddings
+                        embedding_cache (bool): whether to use the embedding cache of corpus files
+                        read_workers (int): n. of processes reading every columnar corpus file (with embedding_cache)
+
+                Returns:
+                        (List(TopicLocation), float, BERTopic, pandas.DataFrame): locations of topics, unit of
+                            Y, topic model and frequency of every topic at every timestamp
+    '''
+    # Imported here, since they take long to load
+    from bertopic import BERTopic
+    import pandas as pd
+
+    # Stratified sample: every sample_fraction-th document of every time slice
+    corpus = []
+    timestamps = []
+    embeddings = []
+    for (t, corpus_file) in enumerate(corpora_files):
+        corpus_in = openCorpus(corpus_file)
+        n = len(corpus)
+        if embedding_cache:
+            texts = corpus_in.texts(workers=read_workers)
+            corpus += texts[::sample_fraction]
+            embeddings.append(np.asarray(
+                corpusEmbeddings(corpus_in.file, texts, embedding_model, embedding_dtype)[::sample_fraction],
+                dtype=np.float32))
+        else:
+            i = 0
+            for batch in corpus_in.textBatches(batch_size):
+                corpus += batch[(-i) % sample_fraction::sample_fraction]
+                i += len(batch)
+        timestamps += [t] * (len(corpus) - n)
+        logger.warning(f'Sampled corpus {corpus_file} {t} {len(corpus) - n}')
+    logger.warning(f'Sampled corpus size: {len(corpus)}')
+
+    topic_model = BERTopic(top_n_words=bert_top_n_words, min_topic_size=bert_min_topic_size,
+                           embedding_model=embedding_model)
+    with metrics.stage('clustering', len(corpus)):
+        if embedding_cache:
+            topic_model.fit(corpus, embeddings=np.concatenate(embeddings))
+        else:
+            topic_model.fit(corpus)
+    logger.warning('Done computing topics')
+    del corpus, embeddings
+
+    # Frequency of every topic at every timestamp, over all the documents
+    frequencies = []
+    for (t, corpus_file) in enumerate(corpora_files):
+        frequencies += assignSlice(topic_model, corpus_file, t, batch_size, 1,
+                                   embedding_model, embedding_dtype, embedding_cache, read_workers)
+    topics_over_time = pd.DataFrame(frequencies, columns=['Topic', 'Frequency', 'Timestamp'])
+
+    return topicLocations(topic_model, topics_over_time, timestamps) + (topic_model, topics_over_time)
+
+
+def assignSlice(topic_model, corpus_file, t, batch_size, step=1,
+                embedding_model=None, embedding_dtype=None, embedding_cache=False, read_workers=1):
+    '''
+        Assign the documents of a time slice to the topics of a fitted model, reading batch_size
+        documents at a time. Every document is counted as many times as its count (the n. of documents
+        it stands for, duplicates collapsed into it included)
+
+                Parameters:
+                        topic_model (BERTopic): fitted topic model
+                        corpus_file (String): corpus file (minus the extension) of the time slice
+                        t (int): timestamp of the time slice
+                        batch_size (int): n. of documents assigned to topics at once
+                        step (int): one document out of step is assigned (1 to assign all documents)
+                        embedding_model (String): sentence-transformers model used to embed documents
+                        embedding_dtype (String): type of the cached embeddings
+                        embedding_cache (bool): whether to use the embedding cache of corpus files
+                        read_workers (int): n. of processes reading every columnar corpus file (with embedding_cache)
+
+                Returns:
+                        List(Dict): frequency of every topic in the time slice, as topics_over_time rows
+    '''
+    corpus_in = openCorpus(corpus_file)
+    counts = Counter()
+    with metrics.stage('assignment') as stage:
+        stage.items = 0
+        if embedding_cache:
+            (texts, weights) = corpus_in.textsAndCounts(read_workers)
+            embeddings_t = corpusEmbeddings(corpus_in.file, texts, embedding_model, embedding_dtype)[::step]
+            texts = texts[::step]
+            weights = weights[::step]
+            for i in range(0, len(texts), batch_size):
+                (doc_to_topic, doc_to_topic_prob) = topic_model.transform(
+                    texts[i:i + batch_size], embeddings=np.asarray(embeddings_t[i:i + batch_size], dtype=np.float32))
+                for (topic, w) in zip(doc_to_topic, weights[i:i + batch_size]):
+                    counts[topic] += w
+                stage.items += len(doc_to_topic)
+        else:
+            i = 0
+            for (batch, weights) in corpus_in.textAndCountBatches(batch_size):
+                (doc_to_topic, doc_to_topic_prob) = topic_model.transform(batch[(-i) % step::step])
+                for (topic, w) in zip(doc_to_topic, weights[(-i) % step::step]):
+                    counts[topic] += w
+                stage.items += len(doc_to_topic)
+                i += len(batch)
+    logger.warning(f'Assigned corpus {corpus_file} {t} {sum(counts.values())}')
+    return [{'Topic': int(topic), 'Frequency': n, 'Timestamp': t} for (topic, n) in sorted(counts.items())]
+
+
+def outlierRatio(topics_over_time):
+    '''
+        Compute the fraction of documents not assigned to any topic
+
+                Parameters:
+                        topics_over_time (pandas.DataFrame): frequency of every topic at every timestamp
+
+                Returns:
+                        float: fraction of documents in the -1 topic
+    '''
+    total = topics_over_time['Frequency'].sum()
+    return topics_over_time.loc[topics_over_time['Topic'] == -1, 'Frequency'].sum() / total if total > 0 else 0.0
+
+
+def saveModel(model_file, topic_model, topics_over_time, corpora_files, assign_all, locs, y_unit):
+    '''
+        Save a fitted topic model and the state needed to add time slices to it incrementally
+
+                Parameters:
+                        model_file (String): output file name (minus the extension)
+                        topic_model (BERTopic): fitted topic model
+                        topics_over_time (pandas.DataFrame): frequency of every topic at every timestamp
+                        corpora_files (List(String)): corpus files (minus the extension), one per timestamp
+                        assign_all (bool): whether frequencies are computed over all documents or over a sample
+                        locs (List(TopicLocation)): locations of topics, kept as they are by later updates
+                        y_unit (float): unit of Y the topics are placed with, that new time slices are placed with
+    '''
+    topic_model.save(f'{model_file}.topicmodel')
+    with open(f'{model_file}.topicstate.json', 'w') as f:
+        f.write(json.dumps({
+            'corpora_files': corpora_files,
+            'assign_all': assign_all,
+            'outlier_ratio': float(outlierRatio(topics_over_time)),
+            'topics_over_time': [{'Topic': int(r.Topic), 'Frequency': int(r.Frequency), 'Timestamp': int(r.Timestamp)}
+                                 for r in topics_over_time.itertuples()],
+            'y_unit': float(y_unit),
+            'locations': [{'x': int(loc.x), 'y': float(loc.y), 't': int(loc.t), 'id': int(loc.id), 'label': loc.label,
+                           'top_terms': [(w, float(s)) for (w, s) in loc.top_terms], 'n': int(loc.n)}
+                          for loc in locs]
+        }))
+    logger.warning(f'Written {model_file}.topicmodel')
+
+
+def updateTopics(model_file, corpora_files, sample_fraction, batch_size, drift_threshold,
+                 embedding_model=None, embedding_dtype=None, embedding_cache=False, assign_all=False, read_workers=1):
+    '''
+        Add new time slices to a saved topic model: the documents of new corpus files are assigned to
+        the existing topics, and their frequencies appended to the saved ones, without refitting the model.
+        Topics are placed in the columns of the new time slices only, with the saved unit of Y, and
+        appended to the saved locations, which are kept as they are
+
+                Parameters:
+                        model_file (String): saved model file name (minus the extension)
+                        corpora_files (List(String)): corpus files (minus the extension), old and new
+                        sample_fraction (int): one document out of sample_fraction is assigned, unless the model
+                            frequencies are computed over all documents
+                        batch_size (int): n. of documents assigned to topics at once
+                        drift_threshold (float): maximum increase of the fraction of documents not assigned to
+                            any topic, beyond which the model has to be refitted
+                        embedding_model (String): sentence-transformers model used to embed documents
+                        embedding_dtype (String): type of the cached embeddings
+                        embedding_cache (bool): whether to use the embedding cache of corpus files
+                        assign_all (bool): whether frequencies are computed over all documents; the model has to
+                            be refitted if its frequencies were not computed the same way
+                        read_workers (int): n. of processes reading every columnar corpus file (with embedding_cache)
+
+                Returns:
+                        (List(TopicLocation), float, BERTopic, pandas.DataFrame, List(String)): locations of
+                            topics, unit of Y, topic model, topic frequencies and corpus files of the updated
+                            model, or None if there is no saved model or the model has to be refitted
+    '''
+    from bertopic import BERTopic
+    import pandas as pd
+
+    if not (os.path.exists(f'{model_file}.topicstate.json') and os.path.exists(f'{model_file}.topicmodel')):
+        logger.warning(f'No saved model {model_file}.topicmodel')
+        return None
+
+    with open(f'{model_file}.topicstate.json', 'r') as f:
+        state = json.load(f)
+    if state['assign_all'] != assign_all:
+        logger.warning(f'Saved model has assign_all {state["assign_all"]}, refitting')
+        return None
+    if 'locations' not in state:
+        logger.warning(f'Saved model has no topic locations, refitting')
+        return None
+    topic_model = BERTopic.load(f'{model_file}.topicmodel')
+    old_files = state['corpora_files']
+    new_files = [corpus_file for corpus_file in corpora_files if corpus_file not in old_files]
+    if len(new_files) > 0 and len(old_files) > 0 and new_files[0] < old_files[-1]:
+        logger.warning(f'New corpus file {new_files[0]} precedes {old_files[-1]}, but is added after it')
+
+    frequencies = []
+    for (i, corpus_file) in enumerate(new_files):
+        frequencies += assignSlice(topic_model, corpus_file, len(old_files) + i, batch_size,
+                                   1 if assign_all else sample_fraction,
+                                   embedding_model, embedding_dtype, embedding_cache, read_workers)
+    new_topics_over_time = pd.DataFrame(frequencies, columns=['Topic', 'Frequency', 'Timestamp'])
+
+    if len(new_files) > 0 and outlierRatio(new_topics_over_time) - state['outlier_ratio'] > drift_threshold:
+        logger.warning(f'Outliers grew from {state["outlier_ratio"]:.3f} to {outlierRatio(new_topics_over_time):.3f}, refitting')
+        return None
+
+    topics_over_time = pd.concat(
+        [pd.DataFrame(state['topics_over_time'], columns=['Topic', 'Frequency', 'Timestamp']), new_topics_over_time],
+        ignore_index=True)
+    locs = [TopicLocation(**dict(loc, top_terms=[tuple(w) for w in loc['top_terms']])) for loc in state['locations']]
+    if len(new_files) > 0:
+        locs += topicLocations(topic_model, new_topics_over_time, topics_over_time['Timestamp'].to_list(),
+                               state['y_unit'])[0]
+    logger.warning(f'Added {len(new_files)} time slices')
+    return (locs, state['y_unit'], topic_model, topics_over_time, old_files + new_files)
+
+
+def exportLocations(locs, settings):
+    # Export locations to GeoJSON (or newline-delimited GeoJSON)
+    f = f'{settings.output_dir}/{settings.corpus_prefix}-{settings.model_name}'
+    extension = 'ndjson' if settings.location_format == 'ndjson' else 'geojson'
+    with metrics.stage('location_export', len(locs)):
+        exportTopicLocationToGeoJSON(locs, f'{f}.topiclocation.{extension}',
+                                     settings.x_scale, settings.y_scale, extension == 'ndjson')
+    logger.warning(f'Written {f}.topiclocation.{extension}')
+
+    # Export locations as arrays, that computeSurface reads faster
+    if str(settings.location_arrays).lower() == 'true':
+        exportTopicLocationToNpz(locs, f'{f}.topiclocation.npz', settings.x_scale, settings.y_scale)
+        logger.warning(f'Written {f}.topiclocation.npz')
 
 
 def main():
@@ -118,43 +441,102 @@ def main():
              help='Scale to multiply every unit in the y topic space dimension')
     argp.add('--sample_fraction', required=False, type=int, env_var='SAMPLE_FRACTION',
              help='fraction of the corpus to use')
+    argp.add('--assign_all', required=False, type=str, default='false', env_var='ASSIGN_ALL',
+             help='flag to fit the model on a sample of every time slice, then assign all documents to topics')
+    argp.add('--assign_batch_size', required=False, type=int, default=10000, env_var='ASSIGN_BATCH_SIZE',
+             help='n. of documents assigned to topics at once (with assign_all)')
+    argp.add('--location_format', required=False, type=str, default='geojson', choices=['geojson', 'ndjson'],
+             env_var='LOCATION_FORMAT',
+             help='format of the topic locations file: geojson (FeatureCollection) or ndjson (one feature per line)')
+    argp.add('--location_arrays', required=False, type=str, default='false', env_var='LOCATION_ARRAYS',
+             help='flag to write the topic locations as arrays to a .npz file as well, read by computeSurface')
+    argp.add('--incremental', required=False, type=str, default='false', env_var='INCREMENTAL',
+             help='flag to add new corpus files to the saved model as new time slices, instead of refitting it '
+                  '(the model is fitted and saved if there is none)')
+    argp.add('--drift_threshold', required=False, type=float, default=0.1, env_var='DRIFT_THRESHOLD',
+             help='maximum increase of the fraction of outlier documents in new time slices before refitting '
+                  'the model (with incremental)')
+    argp.add('--embedding_model', required=False, type=str, default='paraphrase-MiniLM-L6-v2',
+             env_var='EMBEDDING_MODEL',
+             help='sentence-transformers model used to embed documents')
+    argp.add('--embedding_cache', required=False, type=str, default='false', env_var='EMBEDDING_CACHE',
+             help='flag to compute document embeddings once per corpus file and reuse them across runs')
+    argp.add('--embedding_dtype', required=False, type=str, default='float32', choices=['float32', 'float16'],
+             env_var='EMBEDDING_DTYPE',
+             help='type of the cached embeddings')
+    argp.add('--read_workers', required=False, type=int, default=1, env_var='N_READ_WORKERS',
+             help='n. of processes reading every columnar corpus file, each one a shard of its documents')
+    addMetricsArguments(argp)
 
     settings = argp.parse_known_args()[0]
-    print(f'{settings.corpora_dir}/{settings.corpus_prefix}*.corpus.pickle')
-    corpora_files = glob.glob(f'{settings.corpora_dir}/{settings.corpus_prefix}*.corpus.pickle')
-    corpora_files.sort()
+    metrics.configure(settings)
+    logger.info(f'Reading corpora {settings.corpora_dir}/{settings.corpus_prefix}*.corpus.*')
+    # Corpora in either format, without extension
+    corpora_files = sorted(set([os.path.splitext(f)[0] for f in
+                                glob.glob(f'{settings.corpora_dir}/{settings.corpus_prefix}*.corpus.pickle') +
+                                glob.glob(f'{settings.corpora_dir}/{settings.corpus_prefix}*.corpus.adc')]))
 
     if len(corpora_files) == 0:
        logger.warning(f'No corpus file to read')
        return
 
-    corpus = []
-    timestamps = []
-    t = 0
-
-    # For every file constituting the corpus
-    for corpus_file in corpora_files:
-        logger.warning(f'{corpus_file.replace(".pickle", "")}')
-        corpus_t = [d.text for d in AdoCorpus(corpus_file.replace('.pickle', ''))]
-        corpus += corpus_t
-        timestamps += ([t] * len(corpus_t))
-        logger.warning(f'Read corpus {corpus_file} {t} {len(corpus)} {len(timestamps)}')
-        t += 1
-
-    # Computes topics
-    locs = buildTopics(corpus, timestamps,
-                       settings.bert_top_n_words, settings.bert_min_topic_size,
-                       settings.sample_fraction)
-
-    # Export locations to GeoJSON
-    f = f'{settings.output_dir}/{settings.corpus_prefix}-{settings.model_name}'
-    exportTopicLocationToGeoJSON(locs, f'{f}.topiclocation.geojson',
-                                 settings.x_scale, settings.y_scale)
-    logger.warning(f'Written {f}.topiclocation.geojson')
+    model_file = f'{settings.output_dir}/{settings.corpus_prefix}-{settings.model_name}'
+    incremental = str(settings.incremental).lower() == 'true'
+    assign_all = str(settings.assign_all).lower() == 'true'
+    embedding_cache = str(settings.embedding_cache).lower() == 'true'
+
+    if incremental:
+        update = updateTopics(model_file, corpora_files, settings.sample_fraction, settings.assign_batch_size,
+                              settings.drift_threshold, settings.embedding_model, settings.embedding_dtype,
+                              embedding_cache, assign_all, settings.read_workers)
+        if update is not None:
+            (locs, y_unit, topic_model, topics_over_time, corpora_files) = update
+            saveModel(model_file, topic_model, topics_over_time, corpora_files, assign_all, locs, y_unit)
+            exportLocations(locs, settings)
+            return
+
+    if assign_all:
+        (locs, y_unit, topic_model, topics_over_time) = buildTopicsAssignAll(
+            corpora_files, settings.bert_top_n_words, settings.bert_min_topic_size,
+            settings.sample_fraction, settings.assign_batch_size,
+            settings.embedding_model, settings.embedding_dtype, embedding_cache, settings.read_workers)
+    else:
+        corpus = []
+        timestamps = []
+        counts = []
+        embeddings = [] if embedding_cache else None
+        t = 0
+
+        # For every file constituting the corpus
+        for corpus_file in corpora_files:
+            logger.warning(f'{corpus_file}')
+            corpus_in = openCorpus(corpus_file)
+            with metrics.stage('corpus_read') as stage:
+                (corpus_t, counts_t) = corpus_in.textsAndCounts(settings.read_workers)
+                stage.items = len(corpus_t)
+            corpus += corpus_t
+            timestamps += ([t] * len(corpus_t))
+            counts += counts_t
+            if embeddings is not None:
+                embeddings.append(corpusEmbeddings(corpus_in.file, corpus_t, settings.embedding_model,
+                                                   settings.embedding_dtype))
+            logger.warning(f'Read corpus {corpus_file} {t} {len(corpus)} {len(timestamps)}')
+            t += 1
+
+        # Computes topics
+        (locs, y_unit, topic_model, topics_over_time) = buildTopics(
+            corpus, timestamps,
+            settings.bert_top_n_words, settings.bert_min_topic_size,
+            settings.sample_fraction, embeddings, settings.embedding_model, counts)
+
+    if incremental:
+        saveModel(model_file, topic_model, topics_over_time, corpora_files, assign_all, locs, y_unit)
+    exportLocations(locs, settings)
 
 
 if __name__ == '__main__':
     # WARNING log level is used to avoid gensim printing out very verbose logs at INFO level
     logger.warning(f'Started {__file__}')
     main()
+    metrics.write()
     logger.warning(f'ended')
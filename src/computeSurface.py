@@ -1,82 +1,212 @@
-import sys, os, json, numpy as np, configargparse, math, glob
+import sys, os, json, numpy as np, configargparse, glob
 
 sys.path.append('../src')
 
 from logger import logger
-from export_lib import exportSurfaceToGrid, importTopicLocationFromGeoJSON
-from tqdm import tqdm
+from export_lib import surfaceWriters, importTopicLocationArraysFromGeoJSON, importTopicLocationArrays, \
+    exportContoursToGeoJSON
+from metrics_lib import metrics, addMetricsArguments
+from surface_lib import surfaceGeometry, accumulateKDE, accumulateKDESweep, computeTiledKDE, kernelFootprint, \
+    dirtyWindows, kernelPatches, sumPatches
+from tuples import SurfaceGeometry
 
+DEFAULT_TILE_SIZE = 512
 
-def computeSurface(locs, n_rows, max_dist, z_scale):
+# N. of rows and columns of the tiles the windows recomputed by updateSurface are bounded by
+DIRTY_TILE_SIZE = 64
+
+# Fraction of changed locations above which updateSurface recomputes the whole surface
+DIRTY_FRACTION = 0.5
+
+
+def locationArrays(locs):
+    '''
+        Return the coordinates, values and timestamps of locations
+        :param locs (List(TopicLocation) or Dict(String, numpy.array)): locations, as TopicLocations or as
+            arrays read by importTopicLocationArrays
+        :return: (numpy.array, numpy.array, numpy.array, List(int)): X, Y, values (n) and timestamps
+    '''
+    if isinstance(locs, dict):
+        return (locs['x'], locs['y'], locs['n'], locs['t'].tolist())
+    return (np.array([loc.x for loc in locs]), np.array([loc.y for loc in locs]), np.array([loc.n for loc in locs]),
+            [loc.t for loc in locs])
+
+
+def computeSurface(locs, n_rows, max_dist, z_scale, workers=1, tile_size=0, grid_file=None):
     '''
         Compute surface from a set of features
-        :param locs (List(TopicLocation)): locations to interpolate from
+        :param locs (List(TopicLocation) or Dict(String, numpy.array)): locations to interpolate from, as
+            TopicLocations or as arrays (x, y, t and n) read by importTopicLocationArrays
         :param n_rows (int): n. of rows of the surface
         :param max_dist (int): maximum distance for KDE expressed in distance between intervals
         :param z_scale (float): rescaling factor of Z values
+        :param workers (int): n. of processes computing tiles of the surface
+        :param tile_size (int): n. of rows and columns of every tile (0 to compute the surface in one go)
+        :param grid_file (String): .npy file to memory-map the grid to, instead of holding it in memory
         :return: (numpy.array. size): Tuple(2D array of grid values, grid cell size)
     '''
 
-    def kde_quartic(d, h, z):
-        '''
-        Compute the Quartic kernel Density Estimator of value z
-        :param d (float): distance of z from a give point
-        :param h (float): max distance that affects the KDE computation
-        :param z (float): value to calculate the KDE of
-        :return: (float) Warped Euclidean distance
-        '''
-        if d <= h:
-            return ((15 / 16) * (1 - (d / h) ** 2) ** 2) * z
+    # Extracts coordinates and computer boundaries
+    (x, y, z, ts) = locationArrays(locs)
+    geom = surfaceGeometry(x, y, ts, n_rows, max_dist)
+    n = len(x)
+    t = len(set(ts))
+
+    logger.warning(
+        f'Computing surface ({geom.n_rows},{geom.n_cols}), cell size:{geom.g:.2f} n:{n} t:{t} n per t:{(n / t):.2f} x:{np.max(x)}-{np.min(x)} y:{np.max(y)}-{np.min(y)} max dist:{geom.max_dist_u:.2f} X warp:{geom.x_warp:.2f}')
+
+    if grid_file is not None:
+        gz = np.lib.format.open_memmap(grid_file, mode='w+', dtype=np.float64, shape=(geom.n_rows, geom.n_cols))
+    else:
+        gz = np.zeros([geom.n_rows, geom.n_cols])
+
+    with metrics.stage('kde', n):
+        if workers > 1 or tile_size > 0 or grid_file is not None:
+            tile_size = tile_size if tile_size > 0 else DEFAULT_TILE_SIZE
+            logger.warning(f'Computing tiles of {tile_size} cells with {workers} workers')
+            computeTiledKDE(gz, geom, x, y, z, z_scale, tile_size, workers, grid_file)
         else:
-            return 0
-
-    def warped_euclidian_dist(p1, p2, yx):
-        '''
-        Compute warped Euclidiand distance between points p1 and p2
-        :param p1 (float, float): first point
-        :param p2 (float, float): second point
-        :param yx (float): factor to "stretch" the X distance of
-        :return: (float) KDE value
-        '''
-        return math.sqrt(((p1[0] - p2[0]) ** 2) / yx + (p1[1] - p2[1]) ** 2)
+            accumulateKDE(gz, geom, x, y, z, progress=True)
+            gz *= z_scale
+    return (gz, geom.g)
 
-    # Extracts coordinates and computer boundaries
-    x = np.array([loc.x for loc in locs])
-    y = np.array([loc.y for loc in locs])
-    z = np.array([loc.n for loc in locs])
-    xmin = np.min(x)
-    xmax = np.max(x)
-    ymin = np.min(y)
-    ymax = np.max(y)
 
-    # Computes the cell size based on the number of unique timestamps
-    g = (ymax - ymin) / n_rows
+def sweepSurfaces(locs, n_rows_list, max_dist_list, z_scale_list):
+    '''
+        Compute surfaces from a set of features for every combination of n. of rows, max distance and
+        Z rescaling. Surfaces with the same n. of rows share their grid, hence the distances of locations
+        from cells are computed once for all their max distances; Z rescaling is applied to the computed
+        surfaces
+        :param locs (List(TopicLocation) or Dict(String, numpy.array)): locations to interpolate from
+        :param n_rows_list (List(int)): n. of rows of the surfaces
+        :param max_dist_list (List(float)): maximum distances for KDE expressed in distance between intervals
+        :param z_scale_list (List(float)): rescaling factors of Z values
+        :return: (Generator(Tuple(Tuple(int, float, float), Tuple(numpy.array, size)))): n. of rows, max
+            distance and Z rescaling of every surface, and the surface as returned by computeSurface
+    '''
+    (x, y, z, ts) = locationArrays(locs)
+    for n_rows in n_rows_list:
+        geoms = [surfaceGeometry(x, y, ts, n_rows, max_dist) for max_dist in max_dist_list]
+        logger.warning(f'Computing {len(geoms)} surfaces ({geoms[0].n_rows},{geoms[0].n_cols}), '
+                       f'cell size:{geoms[0].g:.2f} max dist:{",".join([f"{geom.max_dist_u:.2f}" for geom in geoms])}')
+        gzs = [np.zeros([geom.n_rows, geom.n_cols]) for geom in geoms]
+        with metrics.stage('kde', len(x)):
+            accumulateKDESweep(gzs, geoms, x, y, z, progress=True)
+        for (max_dist, geom, gz) in zip(max_dist_list, geoms, gzs):
+            for z_scale in z_scale_list:
+                yield ((n_rows, max_dist, z_scale), (gz * z_scale, geom.g))
+        del gzs
 
-    n_cols = int((xmax - xmin) / g)
-    gz = np.ndarray([n_rows, n_cols])
-    n = len(locs)
-    t = len(set([loc.t for loc in locs]))
 
-    # Ratio of "stratching" of x distance
-    x_warp = n / (t ** 2)
+def geometryDrift(pinned, geom):
+    '''
+        Compute the largest relative difference of cell size, X warp and max distance between the geometry
+        of a grid and a pinned one
+        :param pinned (SurfaceGeometry): pinned geometry
+        :param geom (SurfaceGeometry): geometry computed from the current locations
+        :return: (float) largest relative difference
+    '''
+    return max(abs(getattr(geom, k) - getattr(pinned, k)) / abs(getattr(pinned, k))
+               for k in ('g', 'x_warp', 'max_dist_u'))
 
-    # Max distance for KDE expressed in surface units
-    max_dist_u = max_dist * g * (n_cols / t)
 
-    logger.warning(
-        f'Computing surface ({n_rows},{n_cols}), cell size:{g:.2f} n:{n} t:{t} n per t:{(n / t):.2f} x:{xmax}-{xmin} y:{ymax}-{ymin} max dist:{max_dist_u:.2f} X warp:{x_warp:.2f}')
+def updateSurface(locs, n_rows, max_dist, z_scale, state_file, tolerance=0.05, workers=1):
+    '''
+        Compute surface from a set of features, recomputing only the cells reached by the kernels of the
+        locations added, removed or changed since the surface saved in state_file. The KDE of every
+        location over its kernel footprint is saved as well, hence the cells are recomputed by adding
+        up the saved KDE of the unchanged locations and the one of the changed locations only.
+        The grid geometry of the saved surface is kept (rows and columns are added if the locations
+        reach farther), unless the one of the current locations differs from it by more than tolerance,
+        n_rows or max_dist change, or more than DIRTY_FRACTION of the locations changed, in which case
+        the whole surface is recomputed. The surface equals the one computed from scratch with the
+        saved geometry, and differs from the one computed with the geometry of the current locations
+        as much as their kernels do (cell size, X warp and max distance differ by tolerance at most).
+        The (not rescaled) grid, its geometry, the locations and their KDE are saved back to state_file
+        :param locs (List(TopicLocation) or Dict(String, numpy.array)): locations to interpolate from
+        :param n_rows (int): n. of rows of the surface
+        :param max_dist (int): maximum distance for KDE expressed in distance between intervals
+        :param z_scale (float): rescaling factor of Z values
+        :param state_file (String): .npz file holding the state of the surface across runs
+        :param tolerance (float): relative difference of cell size, X warp and max distance the geometry
+            is kept within
+        :param workers (int): n. of processes computing the KDE of locations
+        :return: (numpy.array. size): Tuple(2D array of grid values, grid cell size)
+    '''
+    (x, y, z, ts) = locationArrays(locs)
+    (x, y, z) = (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), np.asarray(z, dtype=np.float64))
+    geom = surfaceGeometry(x, y, ts, n_rows, max_dist)
+
+    state = dict(np.load(state_file)) if os.path.exists(state_file) else None
+    matches = None
+    if state is not None and 'patches' in state and float(state['max_dist']) == max_dist \
+            and int(state['base_rows']) == n_rows:
+        pinned = SurfaceGeometry(n_rows=int(state['n_rows']), n_cols=int(state['n_cols']), g=float(state['g']),
+                                 x_warp=float(state['x_warp']), max_dist_u=float(state['max_dist_u']))
+        drift = geometryDrift(pinned, geom)
+        if drift <= tolerance:
+            # Saved location every current one is identical to (in coordinates and value), -1 if none
+            old = np.stack([state['x'], state['y'], state['z']], axis=1)
+            index = {row.tobytes(): i for (i, row) in enumerate(old)}
+            matches = np.array([index.get(row.tobytes(), -1) for row in np.stack([x, y, z], axis=1)], dtype=np.int64)
+            removed = np.setdiff1d(np.arange(len(old)), matches)
+            n_dirty = int((matches < 0).sum()) + len(removed)
+            if n_dirty > DIRTY_FRACTION * len(x):
+                logger.warning(f'{n_dirty} changed locations out of {len(x)}')
+                matches = None
+        else:
+            logger.warning(f'Grid geometry changed by {drift:.1%}')
+
+    if matches is None:
+        logger.warning(f'Computing the whole surface')
+        with metrics.stage('kde', len(x)):
+            (footprint, offsets, patches) = kernelPatches(geom, x, y, z, workers)
+            gz = sumPatches(np.zeros([geom.n_rows, geom.n_cols]), footprint, offsets, patches,
+                            [(0, geom.n_rows, 0, geom.n_cols)])
+    else:
+        # The grid grows as the full one would, with the saved cell size
+        geom = pinned._replace(n_rows=max(pinned.n_rows, int((np.max(y) - np.min(y)) / pinned.g)),
+                               n_cols=max(pinned.n_cols, int((np.max(x) - np.min(x)) / pinned.g)))
+        footprint = kernelFootprint(geom, x, y)
+        old_footprint = (state['r0'], state['r1'], state['c0'], state['c1'])
 
-    for r in tqdm(range(n_rows)):
-        for c in range(n_cols):
-            gz[r, c] = 0
-            for i in range(len(x)):
-                gz[r, c] += kde_quartic(
-                    warped_euclidian_dist((c * g, r * g), (x[i], y[i]), x_warp),
-                    max_dist_u,
-                    z[i]
-                )
-            gz[r, c] = gz[r, c] * z_scale
-    return (gz, g)
+        # The saved KDE of unchanged locations is kept, unless their footprint grows with the grid
+        kept = matches >= 0
+        kept[kept] = np.all([f[kept] == o[matches[kept]] for (f, o) in zip(footprint, old_footprint)], axis=0)
+        changed = np.nonzero(matches < 0)[0]
+        stale = np.nonzero(~kept)[0]
+
+        with metrics.stage('kde', len(stale)):
+            (_, stale_offsets, stale_patches) = kernelPatches(geom, x[stale], y[stale], z[stale], workers)
+            offsets = np.zeros(len(x) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum((footprint[1] - footprint[0]) * (footprint[3] - footprint[2]))
+            patches = np.zeros(offsets[-1])
+            for (j, i) in enumerate(stale):
+                patches[offsets[i]:offsets[i + 1]] = stale_patches[stale_offsets[j]:stale_offsets[j + 1]]
+            for i in np.nonzero(kept)[0]:
+                patches[offsets[i]:offsets[i + 1]] = state['patches'][
+                    state['offsets'][matches[i]]:state['offsets'][matches[i] + 1]]
+
+            # Cells reached by the kernels of the changed and removed locations, and the added rows and columns
+            dirty = [np.concatenate([f[changed], o[removed]]) for (f, o) in zip(footprint, old_footprint)]
+            windows = dirtyWindows(geom, dirty, DIRTY_TILE_SIZE)
+            gz = np.zeros([geom.n_rows, geom.n_cols])
+            gz[:pinned.n_rows, :pinned.n_cols] = state['gz']
+            if geom.n_rows > pinned.n_rows:
+                windows += [(pinned.n_rows, geom.n_rows, c, min(c + DIRTY_TILE_SIZE, geom.n_cols))
+                            for c in range(0, geom.n_cols, DIRTY_TILE_SIZE)]
+            if geom.n_cols > pinned.n_cols:
+                windows += [(r, min(r + DIRTY_TILE_SIZE, pinned.n_rows), pinned.n_cols, geom.n_cols)
+                            for r in range(0, pinned.n_rows, DIRTY_TILE_SIZE)]
+            logger.warning(f'Updating surface ({geom.n_rows},{geom.n_cols}), geometry drift {drift:.1%}: '
+                           f'{len(changed) + len(removed)} changed locations, {len(stale)} kernels computed, '
+                           f'{sum((w[1] - w[0]) * (w[3] - w[2]) for w in windows)} cells in {len(windows)} windows')
+            sumPatches(gz, footprint, offsets, patches, windows)
+
+    np.savez(state_file, gz=gz, x=x, y=y, z=z, max_dist=max_dist, base_rows=n_rows, r0=footprint[0],
+             r1=footprint[1], c0=footprint[2], c1=footprint[3], offsets=offsets, patches=patches, **geom._asdict())
+    logger.warning(f'Written {state_file}')
+    return (gz * z_scale, geom.g)
 
 
 def main():
@@ -93,27 +223,104 @@ def main():
              help='Max distance (expressed in distance between consecutive timee intervals) the KDE uses')
     argp.add('--z_scale', required=False, nargs='?', const=1, default=1, type=float, env_var='Z_SCALE',
              help='Z rescaling')
+    argp.add('--sweep_n_rows', required=False, nargs='+', type=int, env_var='SWEEP_N_ROWS',
+             help='N. of rows of the surfaces of a parameter sweep (defaults to n_rows)')
+    argp.add('--sweep_max_dist', required=False, nargs='+', type=float, env_var='SWEEP_MAX_DIST',
+             help='Max distances of the surfaces of a parameter sweep (defaults to max_dist)')
+    argp.add('--sweep_z_scale', required=False, nargs='+', type=float, env_var='SWEEP_Z_SCALE',
+             help='Z rescalings of the surfaces of a parameter sweep (defaults to z_scale)')
+    argp.add('--workers', required=False, nargs='?', const=1, default=1, type=int, env_var='N_WORKERS',
+             help='N. of processes computing tiles of the surface')
+    argp.add('--tile_size', required=False, nargs='?', const=1, default=0, type=int, env_var='TILE_SIZE',
+             help=f'N. of rows and columns of every surface tile (0 uses {DEFAULT_TILE_SIZE} when tiling)')
+    argp.add('--incremental', required=False, type=str, default='false', env_var='INCREMENTAL',
+             help='flag to save the surface state in the output directory, and to recompute only the cells reached by '
+                  'locations added, removed or changed since the previous run')
+    argp.add('--geometry_tolerance', required=False, default=0.05, type=float, env_var='GEOMETRY_TOLERANCE',
+             help='relative change of cell size, X warp and max distance of the grid that makes incremental runs '
+                  'recompute the whole surface')
+    argp.add('--parser_backend', required=False, type=str, default='auto', choices=['auto', 'ijson', 'json_stream'],
+             env_var='PARSER_BACKEND',
+             help='parser of the GeoJSON file: ijson, json_stream, or auto (ijson if its C backend is installed)')
+    argp.add('--out_of_core', required=False, type=str, default='false', env_var='OUT_OF_CORE',
+             help='flag to memory-map the surface grid to a .npy file in the output directory instead of holding it in memory')
+    argp.add('--output_format', required=False, nargs='+', default=['asc'], choices=list(surfaceWriters.keys()),
+             env_var='OUTPUT_FORMAT',
+             help='surface output formats: asc (ESRI ASCII Grid), npy (NumPy array), flt (ESRI binary grid), tif (GeoTIFF), '
+                  'pyramid (multi-resolution binary tiles and a JSON index)')
+    argp.add('--contour_levels', required=False, nargs='+', type=float, env_var='CONTOUR_LEVELS',
+             help='Z values (after rescaling) of the iso-lines of the surface to write as GeoJSON LineStrings')
+    argp.add('--pyramid_tile_size', required=False, default=256, type=int, env_var='PYRAMID_TILE_SIZE',
+             help='N. of rows and columns of every tile of the pyramid output format')
+    addMetricsArguments(argp)
 
     settings = argp.parse_known_args()[0]
-    geojson_files = glob.glob(f'{settings.input_dir}/{settings.model_name}.topiclocation.geojson')
+    metrics.configure(settings)
+    geojson_files = glob.glob(f'{settings.input_dir}/{settings.model_name}.topiclocation.geojson') + \
+                    glob.glob(f'{settings.input_dir}/{settings.model_name}.topiclocation.ndjson')
     geojson_files.sort()
 
     for file_name in geojson_files:
         logger.warning(f'Read file {file_name}')
 
-        # Export surface as ASCII Grid file
-        grid_file_name = f'{settings.output_dir}/{settings.model_name}.surface.asc'
-        exportSurfaceToGrid(
-            computeSurface(
-                importTopicLocationFromGeoJSON(file_name),
-                settings.n_rows, settings.max_dist, settings.z_scale
-            ),
-            grid_file_name)
-        logger.warning(f'Written {grid_file_name}')
+        memmap_file_name = f'{settings.output_dir}/{settings.model_name}.surface.npy' \
+            if str(settings.out_of_core).lower() == 'true' else None
+
+        # Locations are read from the array sidecar, if it is up-to-date with the GeoJSON file
+        arrays_file_name = f'{os.path.splitext(file_name)[0]}.npz'
+        with metrics.stage('location_import') as stage:
+            if os.path.exists(arrays_file_name) and os.path.getmtime(arrays_file_name) >= os.path.getmtime(file_name):
+                logger.warning(f'Read file {arrays_file_name}')
+                locs = importTopicLocationArrays(arrays_file_name)
+                stage.items = len(locs['x'])
+            else:
+                locs = importTopicLocationArraysFromGeoJSON(file_name, settings.parser_backend)
+                stage.items = len(locs['x'])
+
+        # A parameter sweep writes a surface for every combination of parameters, named after them
+        if settings.sweep_n_rows is not None or settings.sweep_max_dist is not None or settings.sweep_z_scale is not None:
+            surfaces = ((f'{settings.model_name}.surface.r{n_rows}-d{max_dist:g}-z{z_scale:g}', surf)
+                        for ((n_rows, max_dist, z_scale), surf) in sweepSurfaces(
+                            locs,
+                            settings.sweep_n_rows or [settings.n_rows],
+                            settings.sweep_max_dist or [settings.max_dist],
+                            settings.sweep_z_scale or [settings.z_scale]))
+        elif str(settings.incremental).lower() == 'true':
+            surf = updateSurface(
+                locs,
+                settings.n_rows, settings.max_dist, settings.z_scale,
+                f'{settings.output_dir}/{settings.model_name}.surface.state.npz',
+                settings.geometry_tolerance, settings.workers
+            )
+            surfaces = [(f'{settings.model_name}.surface', surf)]
+        else:
+            surf = computeSurface(
+                locs,
+                settings.n_rows, settings.max_dist, settings.z_scale,
+                settings.workers, settings.tile_size, memmap_file_name
+            )
+            surfaces = [(f'{settings.model_name}.surface', surf)]
+
+        # Export every surface in every output format
+        for (surface_name, surf) in surfaces:
+            for output_format in settings.output_format:
+                (writer, extension) = surfaceWriters[output_format]
+                grid_file_name = f'{settings.output_dir}/{surface_name}.{extension}'
+                options = {'tile_size': settings.pyramid_tile_size} if output_format == 'pyramid' else {}
+                with metrics.stage('grid_export', surf[0].size):
+                    writer(surf, grid_file_name, **options)
+                logger.warning(f'Written {grid_file_name}')
+
+            if settings.contour_levels is not None:
+                contours_file_name = f'{settings.output_dir}/{surface_name}.contours.geojson'
+                with metrics.stage('contours') as stage:
+                    stage.items = exportContoursToGeoJSON(surf, settings.contour_levels, contours_file_name)
+                logger.warning(f'Written {contours_file_name}')
 
 
 if __name__ == '__main__':
     # WARNING log level is used to avoid gensim printing out very verbose logs at INFO level
     logger.warning(f'Started {__file__}')
     main()
+    metrics.write()
     logger.warning(f'ended')
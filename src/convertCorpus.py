@@ -0,0 +1,33 @@
+'''
+    Convert corpora from the pickle format to the columnar format of AdoColumnarCorpus
+'''
+
+import sys, glob
+
+sys.path.append('../src')
+
+from logger import logger
+from AdoColumnarCorpus import convertCorpus
+import configargparse
+
+
+def main():
+    argp = configargparse.ArgParser()
+    argp.add('--corpora_dir', required=False, type=str, env_var='CORPORA_DIR',
+             help='directory holding the corpora')
+    argp.add('--corpus_prefix', required=True, type=str, env_var='CORPUS_PREFIX',
+             help='input corpus file name prefix')
+
+    settings = argp.parse_known_args()[0]
+    corpora_files = glob.glob(f'{settings.corpora_dir}/{settings.corpus_prefix}*.corpus.pickle')
+    corpora_files.sort()
+
+    for corpus_file in corpora_files:
+        n = convertCorpus(corpus_file.replace('.pickle', ''))
+        logger.warning(f'Converted {corpus_file} ({n} documents)')
+
+
+if __name__ == '__main__':
+    logger.warning(f'Started {__file__}')
+    main()
+    logger.warning(f'ended')
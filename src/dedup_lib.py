@@ -0,0 +1,124 @@
+import hashlib, zlib, numpy as np
+
+'''
+    Collapsing of duplicate documents (e.g. retweets and copy-paste campaigns) into one document, whose
+    count is the number of documents it stands for. Documents with the same tokens are found by hashing
+    them; documents with near-identical term sets by MinHash signatures, whose bands are indexed for
+    Locality-Sensitive Hashing (LSH), and checked against the Jaccard similarity of their term sets.
+'''
+
+
+class Deduplicator:
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, seed=0):
+        self.threshold = threshold  # Minimum Jaccard similarity of the term sets of near-duplicates
+        self.bands = bands
+        self.rows = num_perm // bands  # Rows of the signature in every band
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hash functions: the upper 32 bits of (a * x + b) modulo 2^64, with odd a
+        self.a = rng.integers(1, 1 << 63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self.vocabulary = None  # Vocabulary of the documents, whose ids terms are hashed and compared by
+        self.term_hashes = {}  # Hashes of terms, indexed by vocabulary id
+        self.exact_keys = {}  # Representatives of exact duplicates, indexed by the hash of their tokens
+        self.buckets = [{} for i in range(bands)]  # Representatives of near-duplicates, indexed by band
+        self.term_sets = []  # Term sets of the representatives of near-duplicates
+        self.representatives = []
+
+    # Hash of the tokens of a document, the same for documents with the same tokens in the same order
+    # (vocabulary ids are shared by all the documents of a Deduplicator)
+    def exactKey(self, document):
+        self.checkVocabulary(document)
+        return hashlib.blake2b(document.token_ids.tobytes(), digest_size=16).digest()
+
+    def exact(self, documents):
+        '''
+            Collapse the documents with the same tokens (and the ones seen before by this Deduplicator)
+
+                    Parameters:
+                            documents (List(AdoDocument)): documents
+
+                    Returns:
+                            List(AdoDocument): documents not duplicating previous ones, with their count
+                                increased by the one of their duplicates
+        '''
+        kept = []
+        for d in documents:
+            key = self.exactKey(d)
+            representative = self.exact_keys.get(key)
+            if representative is not None:
+                representative.count += d.count
+            else:
+                self.exact_keys[key] = d
+                kept.append(d)
+        return kept
+
+    # Documents are compared by vocabulary ids, hence they have to share their vocabulary
+    def checkVocabulary(self, document):
+        if self.vocabulary is None:
+            self.vocabulary = document.vocabulary
+        elif document.vocabulary is not self.vocabulary:
+            raise ValueError(f'Document {document.id} does not share the vocabulary of the previous documents')
+
+    def signature(self, term_ids):
+        '''
+            Compute the MinHash signature of a set of terms
+
+                    Parameters:
+                            term_ids (Set(int)): vocabulary ids of the terms
+
+                    Returns:
+                            numpy.array: minimum hash of the terms for every hash function
+        '''
+        x = np.array([self.termHash(i) for i in term_ids], dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            return ((self.a[:, np.newaxis] * x[np.newaxis, :] + self.b[:, np.newaxis]) >> np.uint64(32)).min(axis=1)
+
+    def termHash(self, term_id):
+        h = self.term_hashes.get(term_id)
+        if h is None:
+            h = self.term_hashes[term_id] = zlib.crc32(self.vocabulary.words[term_id].encode('UTF-8'))
+        return h
+
+    def near(self, documents):
+        '''
+            Collapse the documents whose term sets are near-identical (and the ones seen before by
+            this Deduplicator). Documents without terms are always kept
+
+                    Parameters:
+                            documents (List(AdoDocument)): documents, with terms extracted already
+
+                    Returns:
+                            List(AdoDocument): documents not duplicating previous ones, with their count
+                                increased by the one of their near-duplicates
+        '''
+        kept = []
+        for d in documents:
+            self.checkVocabulary(d)
+            term_set = set(d.token_ids)
+            if len(term_set) == 0:
+                kept.append(d)
+                continue
+
+            sig = self.signature(term_set)
+            keys = [sig[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+            representative = None
+            for (band, key) in enumerate(keys):
+                candidate = self.buckets[band].get(key)
+                if candidate is not None and jaccard(term_set, self.term_sets[candidate]) >= self.threshold:
+                    representative = self.representatives[candidate]
+                    break
+
+            if representative is not None:
+                representative.count += d.count
+                continue
+            for (band, key) in enumerate(keys):
+                self.buckets[band].setdefault(key, len(self.representatives))
+            self.term_sets.append(term_set)
+            self.representatives.append(d)
+            kept.append(d)
+        return kept
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b)
@@ -0,0 +1,87 @@
+import hashlib, os, re, numpy as np
+from logger import logger
+from metrics_lib import metrics
+
+'''
+    Cache of the document embeddings of corpus files, stored as .npy files next to the corpus files
+    and keyed by the size, modification time and header of the corpus file and the name of the embedding model
+'''
+
+
+_corpus_keys = {}
+
+
+def corpusKey(corpus_path, header_size=1 << 20):
+    '''
+        Compute a cheap key of the content of a corpus file: its size, its modification time and the SHA-1 of its
+        first header_size bytes; keys are remembered per file, size and modification time, so a file is read at most
+        once per process
+
+                Parameters:
+                        corpus_path (String): corpus file (with extension)
+                        header_size (int): n. of bytes hashed from the start of the file
+
+                Returns:
+                        String: key of the file content
+    '''
+    stat = os.stat(corpus_path)
+    memo_key = (os.path.abspath(corpus_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _corpus_keys:
+        h = hashlib.sha1(f'{stat.st_size}:{stat.st_mtime_ns}:'.encode())
+        with open(corpus_path, 'rb') as f:
+            h.update(f.read(header_size))
+        _corpus_keys[memo_key] = h.hexdigest()
+    return _corpus_keys[memo_key]
+
+
+def embeddingCacheFile(corpus_path, embedding_model, dtype):
+    '''
+        Return the name of the embedding cache file of a corpus file
+
+                Parameters:
+                        corpus_path (String): corpus file (with extension)
+                        embedding_model (String): name of the sentence-transformers model
+                        dtype (String): type of the embeddings (float32 or float16)
+
+                Returns:
+                        String: embedding cache file name
+    '''
+    model_slug = re.sub(r'[^A-Za-z0-9_.-]', '_', embedding_model)
+    return f'{os.path.splitext(corpus_path)[0]}.{model_slug}.{corpusKey(corpus_path)[0:16]}.{dtype}.emb.npy'
+
+
+def corpusEmbeddings(corpus_path, texts, embedding_model, dtype='float32', batch_size=10000):
+    '''
+        Return the embeddings of the documents of a corpus file, computing them only if they are not
+        in the cache already
+
+                Parameters:
+                        corpus_path (String): corpus file (with extension)
+                        texts (List(String)): text of the documents of the corpus file
+                        embedding_model (String): name of the sentence-transformers model
+                        dtype (String): type of the embeddings stored in the cache (float32 or float16)
+                        batch_size (int): n. of documents encoded and written at once
+
+                Returns:
+                        numpy.array: memory-mapped embeddings, one row per document
+    '''
+    cache_file = embeddingCacheFile(corpus_path, embedding_model, dtype)
+    if os.path.exists(cache_file):
+        logger.warning(f'Read embeddings from {cache_file}')
+        return np.load(cache_file, mmap_mode='r')
+
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(embedding_model)
+    tmp_file = f'{cache_file}.tmp'
+    embeddings = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype,
+                                           shape=(len(texts), model.get_sentence_embedding_dimension()))
+    with metrics.stage('embedding', len(texts)):
+        for i in range(0, len(texts), batch_size):
+            embeddings[i:i + batch_size] = model.encode(texts[i:i + batch_size])
+    embeddings.flush()
+    del embeddings
+
+    # The cache file appears only once complete
+    os.replace(tmp_file, cache_file)
+    logger.warning(f'Written embeddings to {cache_file}')
+    return np.load(cache_file, mmap_mode='r')
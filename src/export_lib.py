@@ -1,5 +1,7 @@
-import json
+import json, os, numpy as np
+from array import array
 from tuples import TopicLocation
+from rows_lib import parserBackend
 
 
 def topTermsAsList(terms):
@@ -31,13 +33,14 @@ def topTermsAsString(terms):
     return ','.join(topTermsAsList(terms))
 
 
-def exportSurfaceToGrid(surf, out_file_name):
+def exportSurfaceToGrid(surf, out_file_name, block_rows=256):
     '''
-        Export surface as ASCII Grid data
+        Export surface as ASCII Grid data. Values are formatted one block of rows at a time
 
                 Parameters:
                         surf (Tuple): Tuple as returned by computeSurface
                         out_file (String): ESRI Grid ASCII export file
+                        block_rows (int): n. of rows formatted and written at once
     '''
 
     with open(out_file_name, 'wb') as f:
@@ -45,50 +48,431 @@ def exportSurfaceToGrid(surf, out_file_name):
             f'NROWS {surf[0].shape[0]}\nNCOLS {surf[0].shape[1]}\nXLLCENTER 0\nYLLCENTER 0\nDX {surf[1]}\nDY {surf[1]}\nNODATA_VALUE -1\n',
             'UTF-8'))
 
-        for r in range(surf[0].shape[0]):
-            for c in range(surf[0].shape[1]):
-                f.write(bytes(f' {(surf[0][r, c]):9.3f}', 'UTF-8'))
-            f.write(bytes('\n', 'UTF-8'))
+        row_format = ' %9.3f' * surf[0].shape[1] + '\n'
+        for r in range(0, surf[0].shape[0], block_rows):
+            block = surf[0][r:r + block_rows].tolist()
+            f.write(bytes(''.join([row_format % tuple(row) for row in block]), 'UTF-8'))
 
 
-def exportTopicLocationToGeoJSON(tl, out_file, x_scale, y_scale):
+def exportSurfaceToNpy(surf, out_file_name, block_rows=256):
     '''
-        Write topic locationa as a GeoJSON file to out_file
+        Export surface as a NumPy .npy file, which can be memory-mapped with numpy.load(mmap_mode='r').
+        The cell size is written to a sidecar .json file
 
                 Parameters:
-                        tl (List(TopicLocation)): locations to export
+                        surf (Tuple): Tuple as returned by computeSurface
+                        out_file (String): .npy export file
+                        block_rows (int): n. of rows copied at once
+    '''
+    if not (isinstance(surf[0], np.memmap) and os.path.abspath(surf[0].filename) == os.path.abspath(out_file_name)):
+        out = np.lib.format.open_memmap(out_file_name, mode='w+', dtype=surf[0].dtype, shape=surf[0].shape)
+        for r in range(0, surf[0].shape[0], block_rows):
+            out[r:r + block_rows] = surf[0][r:r + block_rows]
+        out.flush()
+        del out
+
+    with open(f'{os.path.splitext(out_file_name)[0]}.json', 'w') as f:
+        f.write(json.dumps({'nrows': surf[0].shape[0], 'ncols': surf[0].shape[1],
+                            'xllcenter': 0, 'yllcenter': 0, 'cellsize': float(surf[1]), 'nodata_value': -1}))
+
+
+def exportSurfaceToFlt(surf, out_file_name, block_rows=256):
+    '''
+        Export surface as ESRI binary grid: a .flt file of little-endian 32 bit floats (rows in the same
+        order of the ASCII Grid) and a .hdr header file
+
+                Parameters:
+                        surf (Tuple): Tuple as returned by computeSurface
+                        out_file (String): .flt export file
+                        block_rows (int): n. of rows converted and written at once
+    '''
+    with open(f'{os.path.splitext(out_file_name)[0]}.hdr', 'w') as f:
+        f.write(
+            f'NROWS {surf[0].shape[0]}\nNCOLS {surf[0].shape[1]}\nXLLCENTER 0\nYLLCENTER 0\nCELLSIZE {surf[1]}\nNODATA_VALUE -1\nBYTEORDER LSBFIRST\n')
+
+    with open(out_file_name, 'wb') as f:
+        for r in range(0, surf[0].shape[0], block_rows):
+            f.write(np.ascontiguousarray(surf[0][r:r + block_rows], dtype='<f4').tobytes())
+
+
+def exportSurfaceToGeoTIFF(surf, out_file_name, block_rows=256):
+    '''
+        Export surface as a tiled and DEFLATE-compressed GeoTIFF (requires rasterio)
+
+                Parameters:
+                        surf (Tuple): Tuple as returned by computeSurface
+                        out_file (String): .tif export file
+                        block_rows (int): n. of rows written at once (multiple of the TIFF tile size)
+    '''
+    try:
+        import rasterio
+        from rasterio.transform import Affine
+        from rasterio.windows import Window
+    except ImportError:
+        raise ImportError('rasterio is required to export surfaces as GeoTIFF')
+
+    (n_rows, n_cols) = surf[0].shape
+    with rasterio.open(out_file_name, 'w', driver='GTiff', width=n_cols, height=n_rows, count=1,
+                       dtype='float32', nodata=-1, tiled=True, blockxsize=256, blockysize=256,
+                       compress='deflate', predictor=3,
+                       # Same georeferencing of the ASCII Grid: first row at the top, lower left cell centered in 0,0
+                       transform=Affine(surf[1], 0, -surf[1] / 2, 0, -surf[1], (n_rows - 0.5) * surf[1])) as dst:
+        for r in range(0, n_rows, block_rows):
+            block = np.asarray(surf[0][r:r + block_rows], dtype=np.float32)
+            dst.write(block, 1, window=Window(0, r, n_cols, block.shape[0]))
+
+
+def coarsenSurface(gz, factor=2, block_rows=256):
+    '''
+        Aggregate a surface grid into a coarser one, whose every cell is the mean of a block of
+        factor x factor cells (blocks at the edges of the grid average the cells they hold only)
+
+                Parameters:
+                        gz (numpy.array): 2D array of grid values
+                        factor (int): n. of rows and columns of cells aggregated into a coarser cell
+                        block_rows (int): n. of rows of the coarser grid computed at once
+
+                Returns:
+                        numpy.array: coarser 2D array of grid values
+    '''
+    (n_rows, n_cols) = gz.shape
+    out = np.empty((-(-n_rows // factor), -(-n_cols // factor)))
+    step = block_rows * factor
+    for r in range(0, n_rows, step):
+        band = np.asarray(gz[r:r + step], dtype=np.float64)
+        # Pads the band to a multiple of factor, with NaNs that are left out of means
+        padded = np.full((-(-band.shape[0] // factor) * factor, out.shape[1] * factor), np.nan)
+        padded[:band.shape[0], :n_cols] = band
+        out[r // factor:r // factor + padded.shape[0] // factor] = np.nanmean(
+            padded.reshape(padded.shape[0] // factor, factor, out.shape[1], factor), axis=(1, 3))
+    return out
+
+
+def exportSurfaceToPyramid(surf, out_file_name, block_rows=256, tile_size=256, factor=2):
+    '''
+        Export surface as a pyramid of tiles: level 0 is the surface itself, and every further level is
+        coarser by factor (see coarsenSurface), down to a level held in a single tile. Every tile is a file
+        of tile_size x tile_size little-endian 32 bit floats (rows in the same order of the ASCII Grid,
+        cells beyond the edges of the grid set to NODATA), named <level>/<row>_<col>.bin in a directory
+        named after out_file_name. The JSON index (out_file_name) lists levels and tiles, with the
+        minimum and maximum values of every tile
+
+                Parameters:
+                        surf (Tuple): Tuple as returned by computeSurface
+                        out_file (String): .pyramid.json index file
+                        block_rows (int): n. of rows aggregated at once when building coarser levels
+                        tile_size (int): n. of rows and columns of every tile
+                        factor (int): ratio of the cell sizes of consecutive levels
+    '''
+    tiles_dir = out_file_name[:-len('.json')] if out_file_name.endswith('.json') else f'{out_file_name}.tiles'
+    index = {'tile_size': tile_size, 'factor': factor, 'dtype': '<f4', 'nodata_value': -1,
+             'tiles_dir': os.path.basename(tiles_dir), 'levels': [], 'tiles': []}
+
+    (gz, level) = (surf[0], 0)
+    while True:
+        (n_rows, n_cols) = gz.shape
+        os.makedirs(f'{tiles_dir}/{level}', exist_ok=True)
+        for r in range(0, n_rows, tile_size):
+            band = np.asarray(gz[r:r + tile_size], dtype='<f4')
+            for c in range(0, n_cols, tile_size):
+                values = band[:, c:c + tile_size]
+                tile = np.full((tile_size, tile_size), -1, dtype='<f4')
+                tile[:values.shape[0], :values.shape[1]] = values
+                with open(f'{tiles_dir}/{level}/{r // tile_size}_{c // tile_size}.bin', 'wb') as f:
+                    f.write(tile.tobytes())
+                index['tiles'].append({'level': level, 'row': r // tile_size, 'col': c // tile_size,
+                                       'min': float(values.min()), 'max': float(values.max())})
+        index['levels'].append({'level': level, 'nrows': n_rows, 'ncols': n_cols,
+                                'cellsize': float(surf[1]) * factor ** level,
+                                'tile_rows': -(-n_rows // tile_size), 'tile_cols': -(-n_cols // tile_size)})
+        if n_rows <= tile_size and n_cols <= tile_size:
+            break
+        gz = coarsenSurface(gz, factor, block_rows)
+        level += 1
+
+    with open(out_file_name, 'w') as f:
+        f.write(json.dumps(index))
+
+
+# Segments of iso-lines crossing a cell of the grid, indexed by the case of the cell (1 for the top left corner
+# above the level, 2 top right, 4 bottom right, 8 bottom left) and by whether the mean of its corners is above the
+# level (which resolves saddles), as pairs of edges of the cell (0 top, 1 right, 2 bottom, 3 left)
+contourCases = {1: [(3, 0)], 2: [(0, 1)], 3: [(3, 1)], 4: [(1, 2)], 6: [(0, 2)], 7: [(3, 2)], 8: [(2, 3)],
+                9: [(0, 2)], 11: [(1, 2)], 12: [(3, 1)], 13: [(0, 1)], 14: [(3, 0)]}
+contourSaddles = {(5, False): [(3, 0), (1, 2)], (5, True): [(0, 1), (2, 3)],
+                  (10, False): [(0, 1), (2, 3)], (10, True): [(3, 0), (1, 2)]}
+contourTable = np.full((16, 2, 2, 2), -1, dtype=np.int64)
+for (case, segments) in contourCases.items():
+    contourTable[case, :, 0:len(segments)] = segments
+for ((case, center), segments) in contourSaddles.items():
+    contourTable[case, int(center), 0:len(segments)] = segments
+
+
+def contourLines(gz, level, g):
+    '''
+        Extract the iso-lines of a surface grid at a level with marching squares: the segments crossing
+        every cell are found for all cells at once, then joined into lines
+
+                Parameters:
+                        gz (numpy.array): 2D array of grid values
+                        level (float): Z value of the iso-lines
+                        g (float): grid cell size
+
+                Returns:
+                        List(numpy.array): lines, as arrays of X and Y coordinates (closed lines end with
+                            their first point)
+    '''
+    z = np.asarray(gz, dtype=np.float64)
+    (n_rows, n_cols) = z.shape
+    if n_rows < 2 or n_cols < 2:
+        return []
+    above = z > level
+    case = above[:-1, :-1] * 1 + above[:-1, 1:] * 2 + above[1:, 1:] * 4 + above[1:, :-1] * 8
+    center = (z[:-1, :-1] + z[:-1, 1:] + z[1:, 1:] + z[1:, :-1]) / 4 > level
+    (r, c) = np.nonzero((case != 0) & (case != 15))
+    table = contourTable[case[r, c], center[r, c].astype(np.int64)]
+
+    # Edges are numbered: horizontal ones (between cells (r, c) and (r, c + 1)) first, vertical ones after
+    n_horizontal = n_rows * (n_cols - 1)
+    edge_ids = np.stack([r * (n_cols - 1) + c, n_horizontal + r * n_cols + c + 1,
+                         (r + 1) * (n_cols - 1) + c, n_horizontal + r * n_cols + c], axis=1)
+    segments = []
+    for k in range(2):
+        i = np.nonzero(table[:, k, 0] >= 0)[0]
+        segments.append(np.stack([edge_ids[i, table[i, k, 0]], edge_ids[i, table[i, k, 1]]], axis=1))
+    segments = np.concatenate(segments)
+    if len(segments) == 0:
+        return []
+
+    # Point where every edge crosses the level, interpolated between the cells at its ends
+    edges = np.unique(segments)
+    horizontal = edges < n_horizontal
+    (er, ec) = np.where(horizontal, np.divmod(edges, n_cols - 1), np.divmod(edges - n_horizontal, n_cols))
+    (z0, z1) = (z[er, ec], np.where(horizontal, z[er, np.minimum(ec + 1, n_cols - 1)], z[np.minimum(er + 1, n_rows - 1), ec]))
+    t = (level - z0) / (z1 - z0)
+    points = np.stack([(ec + np.where(horizontal, t, 0)) * g, (er + np.where(horizontal, 0, t)) * g], axis=1)
+    segments = np.searchsorted(edges, segments)
+
+    # Segments of every edge (every edge is shared by two segments at most)
+    order = np.argsort(segments.ravel(), kind='stable')
+    (first, count) = np.unique(segments.ravel()[order], return_index=True, return_counts=True)[1:]
+    ends = np.full((len(edges), 2), -1, dtype=np.int64)
+    ends[:, 0] = order[first] // 2
+    ends[count == 2, 1] = order[first[count == 2] + 1] // 2
+
+    # Lines start from edges with a single segment (on the border of the grid), then closed lines are followed
+    (ends_0, ends_1) = (ends[:, 0].tolist(), ends[:, 1].tolist())
+    (seg_a, seg_b) = (segments[:, 0].tolist(), segments[:, 1].tolist())
+    visited = [False] * len(seg_a)
+    starts = np.nonzero(ends[:, 1] < 0)[0].tolist() + seg_a
+    lines = []
+    for e in starts:
+        s = ends_0[e]
+        if visited[s]:
+            continue
+        line = [e]
+        while s >= 0 and not visited[s]:
+            visited[s] = True
+            e = seg_b[s] if seg_a[s] == e else seg_a[s]
+            line.append(e)
+            s = ends_0[e] if ends_0[e] != s else ends_1[e]
+        lines.append(points[line])
+    return lines
+
+
+def exportContoursToGeoJSON(surf, levels, out_file):
+    '''
+        Write the iso-lines of a surface at some levels as GeoJSON LineStrings, one feature at a time.
+        Coordinates are the ones of the grid (the center of the first cell being 0,0)
+
+                Parameters:
+                        surf (Tuple): Tuple as returned by computeSurface
+                        levels (List(float)): Z values of the iso-lines
                         out_file (String): GeoJSON output file
+
+                Returns:
+                        int: n. of lines written
+    '''
+    n = 0
+    with open(out_file, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        for level in levels:
+            for line in contourLines(surf[0], level, surf[1]):
+                if n > 0:
+                    f.write(', ')
+                f.write(json.dumps({'type': 'Feature',
+                                    'geometry': {'type': 'LineString', 'coordinates': np.round(line, 6).tolist()},
+                                    'properties': {'level': level}}))
+                n += 1
+        f.write(']}')
+    return n
+
+
+def sampleSurface(surf, x, y, batch_size=100000, nodata=-1):
+    '''
+        Sample a surface at some points by bilinear interpolation of the grid values, a batch of points
+        at a time (so that memory-mapped grids are read only where sampled)
+
+                Parameters:
+                        surf (Tuple): Tuple as returned by computeSurface
+                        x (numpy.array): X coordinates of the points (in the coordinates of the grid)
+                        y (numpy.array): Y coordinates of the points
+                        batch_size (int): n. of points interpolated at once
+                        nodata (float): value of points outside the grid
+
+                Returns:
+                        numpy.array: surface values at the points
+    '''
+    (gz, g) = surf
+    (n_rows, n_cols) = gz.shape
+    (x, y) = (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    values = np.full(len(x), nodata, dtype=np.float64)
+    for i in range(0, len(x), batch_size):
+        (fc, fr) = (x[i:i + batch_size] / g, y[i:i + batch_size] / g)
+        inside = (fc >= 0) & (fc <= n_cols - 1) & (fr >= 0) & (fr <= n_rows - 1)
+        (fc, fr) = (fc[inside], fr[inside])
+        c0 = np.minimum(np.floor(fc).astype(np.int64), max(n_cols - 2, 0))
+        r0 = np.minimum(np.floor(fr).astype(np.int64), max(n_rows - 2, 0))
+        (c1, r1) = (np.minimum(c0 + 1, n_cols - 1), np.minimum(r0 + 1, n_rows - 1))
+        (tc, tr) = (fc - c0, fr - r0)
+        values[i:i + batch_size][inside] = \
+            (gz[r0, c0] * (1 - tc) + gz[r0, c1] * tc) * (1 - tr) + (gz[r1, c0] * (1 - tc) + gz[r1, c1] * tc) * tr
+    return values
+
+
+# Surface export functions and file extensions, indexed by output format
+surfaceWriters = {
+    'asc': (exportSurfaceToGrid, 'asc'),
+    'npy': (exportSurfaceToNpy, 'npy'),
+    'flt': (exportSurfaceToFlt, 'flt'),
+    'tif': (exportSurfaceToGeoTIFF, 'tif'),
+    'pyramid': (exportSurfaceToPyramid, 'pyramid.json')
+}
+
+
+def topicLocationFeature(tl, x_scale, y_scale):
+    '''
+        Convert a topic location to a GeoJSON feature
+
+                Parameters:
+                        tl (TopicLocation): location to convert
                         x_scale (float): scale to apply to X coordinates
                         y_scale (float): scale to apply to y coordinates
 
                 Returns:
-                        List(TopicLocation): features read from the inpout file
+                        Dict: GeoJSON feature
+    '''
+    return {'type': 'Feature',
+            'geometry': {'type': 'Point',
+                         'coordinates': [tl.x * x_scale, tl.y * y_scale]
+                         },
+            'properties': {'t': tl.t,
+                           'label': tl.label,
+                           'top_terms': topTermsAsString(tl.top_terms),
+                           'n': tl.n,
+                           'topic_id': tl.id,
+                           'x': round(tl.x, 6),
+                           'y': round(tl.y, 6)
+                           }
+            }
+
+
+def exportTopicLocationToGeoJSON(tl, out_file, x_scale, y_scale, ndjson=False):
+    '''
+        Write topic locationa as a GeoJSON file to out_file, one feature at a time
+
+                Parameters:
+                        tl (Iterable(TopicLocation)): locations to export
+                        out_file (String): GeoJSON output file
+                        x_scale (float): scale to apply to X coordinates
+                        y_scale (float): scale to apply to y coordinates
+                        ndjson (bool): whether to write one feature per line (newline-delimited GeoJSON)
+                            instead of a FeatureCollection
     '''
-    geo = {'type': 'FeatureCollection', 'features': []}
-    for i in range(0, len(tl)):
-        geo['features'].append({'type': 'Feature',
-                                'geometry': {'type': 'Point',
-                                             'coordinates': [tl[i].x * x_scale, tl[i].y * y_scale]
-                                             },
-                                'properties': {'t': tl[i].t,
-                                               'label': tl[i].label,
-                                               'top_terms': topTermsAsString(tl[i].top_terms),
-                                               'n': tl[i].n,
-                                               'topic_id': tl[i].id,
-                                               'x': round(tl[i].x, 6),
-                                               'y': round(tl[i].y, 6)
-                                               }
-                                })
     with open(out_file, 'w') as f:
-        f.write(json.dumps(geo))
+        if ndjson:
+            for loc in tl:
+                f.write(json.dumps(topicLocationFeature(loc, x_scale, y_scale)))
+                f.write('\n')
+            return
+
+        # Same output as json.dumps() of the whole FeatureCollection
+        f.write('{"type": "FeatureCollection", "features": [')
+        for (i, loc) in enumerate(tl):
+            if i > 0:
+                f.write(', ')
+            f.write(json.dumps(topicLocationFeature(loc, x_scale, y_scale)))
+        f.write(']}')
+
+
+def exportTopicLocationToNpz(tl, out_file, x_scale, y_scale):
+    '''
+        Write the coordinates, timestamps, frequencies and topic ids of topic locations as arrays
+        to a .npz file, that can be read without building TopicLocations
+
+                Parameters:
+                        tl (List(TopicLocation)): locations to export
+                        out_file (String): .npz output file
+                        x_scale (float): scale to apply to X coordinates
+                        y_scale (float): scale to apply to y coordinates
+    '''
+    np.savez(out_file,
+             x=np.array([loc.x * x_scale for loc in tl], dtype=np.float64),
+             y=np.array([loc.y * y_scale for loc in tl], dtype=np.float64),
+             t=np.array([loc.t for loc in tl], dtype=np.int64),
+             n=np.array([loc.n for loc in tl], dtype=np.float64),
+             topic_id=np.array([-1 if loc.id is None else loc.id for loc in tl], dtype=np.int64))
+
+
+def importTopicLocationArrays(in_file_name):
+    '''
+        Read topic location arrays from a .npz file written by exportTopicLocationToNpz
+
+                Parameters:
+                        in_file_name (String): .npz input file
+
+                Returns:
+                        Dict(String, numpy.array): x, y, t, n and topic_id arrays
+    '''
+    with np.load(in_file_name) as npz:
+        return {k: npz[k] for k in ('x', 'y', 't', 'n', 'topic_id')}
 
 
-def importTopicLocationFromGeoJSON(in_file_name):
+def iterGeoJSONFeatures(in_file_name, backend='auto'):
     '''
-        Read topic location data from a GeoJSON file
+        Read the features of a GeoJSON file (a FeatureCollection, or newline-delimited features if the
+        file extension is .ndjson) one at a time
+
+                Parameters:
+                        in_file_name (String): GeoJSON input file
+                        backend (String): parser of FeatureCollections (see rows_lib.parserBackend)
+
+                Returns:
+                        Generator(Dict): features
+    '''
+    if in_file_name.endswith('.ndjson'):
+        with open(in_file_name, 'r') as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    yield json.loads(line)
+    elif parserBackend(backend) == 'ijson':
+        import ijson
+        with open(in_file_name, 'rb') as f:
+            yield from ijson.items(f, 'features.item', use_float=True)
+    else:
+        import json_stream
+        with open(in_file_name, 'r') as f:
+            yield from json_stream.load(f, persistent=False)['features'].persistent()
+
+
+def importTopicLocationFromGeoJSON(in_file_name, backend='auto'):
+    '''
+        Read topic location data from a GeoJSON file (a FeatureCollection, or newline-delimited
+        features if the file extension is .ndjson) one feature at a time
 
                 Parameters:
                         in_file (String): GeoJSON input file
+                        backend (String): parser of FeatureCollections (see rows_lib.parserBackend)
 
                 Returns:
                         List(TopicLocation): features read from the inpout file
@@ -106,7 +490,27 @@ def importTopicLocationFromGeoJSON(in_file_name):
             top_terms=feat['properties']['top_terms']
         )
 
-    with open(in_file_name, 'r') as f:
-        features = json.load(f)['features']
+    return [extractTLfromFeature(feat) for feat in iterGeoJSONFeatures(in_file_name, backend)]
 
-        return [extractTLfromFeature(feat) for feat in features]
+
+def importTopicLocationArraysFromGeoJSON(in_file_name, backend='auto'):
+    '''
+        Read the coordinates, timestamps, frequencies and topic ids of topic locations from a GeoJSON file
+        one feature at a time, without holding features or TopicLocations
+
+                Parameters:
+                        in_file_name (String): GeoJSON input file
+                        backend (String): parser of FeatureCollections (see rows_lib.parserBackend)
+
+                Returns:
+                        Dict(String, numpy.array): x, y, t, n and topic_id arrays, as read by importTopicLocationArrays
+    '''
+    columns = {'x': array('d'), 'y': array('d'), 't': array('q'), 'n': array('d'), 'topic_id': array('q')}
+    for feat in iterGeoJSONFeatures(in_file_name, backend):
+        columns['x'].append(feat['geometry']['coordinates'][0])
+        columns['y'].append(feat['geometry']['coordinates'][1])
+        columns['t'].append(feat['properties']['t'])
+        columns['n'].append(feat['properties']['n'])
+        topic_id = feat['properties'].get('topic_id')
+        columns['topic_id'].append(-1 if topic_id is None else topic_id)
+    return {k: np.frombuffer(v, dtype=np.float64 if v.typecode == 'd' else np.int64) for (k, v) in columns.items()}
@@ -0,0 +1,209 @@
+import cProfile, io, json, os, pstats, resource, sys, threading, time, tracemalloc
+from contextlib import contextmanager
+from types import SimpleNamespace
+from logger import logger
+
+'''
+    Timing, memory and throughput of the named stages of a script (e.g. JSON parse, term extraction,
+    KDE). Stages that run more than once (e.g. once per batch) are summed up. At the end of the
+    script stages are logged, and written as JSON lines to a metrics file; a single stage can be
+    profiled with cProfile or tracemalloc. The memory of a stage is the peak of the resident set size
+    of the process while the stage runs (sampled by a background thread), and its growth over the
+    resident set size at the start of the stage.
+'''
+
+
+class Metrics:
+
+    def __init__(self):
+        self.stages = {}
+        self.metrics_file = None
+        self.profile_stage = None
+        self.profile_mode = None
+        self.profiler = None
+        self.snapshot = None
+        self.traced_peak = 0
+
+    # Set where metrics are written to and which stage is profiled, from the settings added by addMetricsArguments
+    def configure(self, settings):
+        self.metrics_file = settings.metrics_file
+        self.profile_stage = settings.profile_stage
+        self.profile_mode = settings.profile_mode
+
+    # Time a stage; the n. of items it processes can be set on the object returned
+    @contextmanager
+    def stage(self, name, items=None):
+        record = SimpleNamespace(items=items)
+        profiled = name == self.profile_stage
+        if profiled:
+            self.startProfile()
+        (wall0, cpu0) = (time.perf_counter(), time.process_time())
+        rss = rssSampler.start()
+        try:
+            yield record
+        finally:
+            rssSampler.stop(rss)
+            (wall, cpu) = (time.perf_counter() - wall0, time.process_time() - cpu0)
+            if profiled:
+                self.stopProfile()
+            s = self.stages.setdefault(name, {'stage': name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'items': None})
+            s['calls'] += 1
+            s['wall'] += wall
+            s['cpu'] += cpu
+            if record.items is not None:
+                s['items'] = (s['items'] or 0) + record.items
+            s['peak_rss_mb'] = max(s.get('peak_rss_mb', 0), rss.peak)
+            s['rss_growth_mb'] = max(s.get('rss_growth_mb', 0), rss.peak - rss.start)
+
+    # Add the stages recorded by another process (e.g. a process of a pool) to the ones of this one
+    def merge(self, stages):
+        for (name, other) in stages.items():
+            s = self.stages.setdefault(name, {'stage': name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'items': None})
+            s['calls'] += other['calls']
+            s['wall'] += other['wall']
+            s['cpu'] += other['cpu']
+            if other['items'] is not None:
+                s['items'] = (s['items'] or 0) + other['items']
+            s['peak_rss_mb'] = max(s.get('peak_rss_mb', 0), other['peak_rss_mb'])
+            s['rss_growth_mb'] = max(s.get('rss_growth_mb', 0), other['rss_growth_mb'])
+
+    def startProfile(self):
+        if self.profile_mode == 'tracemalloc':
+            tracemalloc.start()
+        else:
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    # Memory still allocated at the end of the (last run of the) stage is kept, along with the peak of all runs
+    def stopProfile(self):
+        if self.profile_mode == 'tracemalloc':
+            self.snapshot = tracemalloc.take_snapshot()
+            self.traced_peak = max(self.traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        else:
+            self.profiler.disable()
+
+    # Log (and write to the metrics file) the profile of the profiled stage
+    def writeProfile(self):
+        if self.profile_mode == 'tracemalloc':
+            self.stages[self.profile_stage]['traced_peak_mb'] = self.traced_peak / (1 << 20)
+            top = '\n'.join([str(stat) for stat in self.snapshot.statistics('lineno')[0:20]])
+            logger.warning(f'Largest allocations of stage {self.profile_stage}:\n{top}')
+        elif self.profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(30)
+            logger.warning(f'Profile of stage {self.profile_stage}:\n{out.getvalue()}')
+            if self.metrics_file is not None:
+                self.profiler.dump_stats(f'{self.metrics_file}.{self.profile_stage}.prof')
+                logger.warning(f'Written {self.metrics_file}.{self.profile_stage}.prof')
+
+    # Log the metrics of every stage, and append them to the metrics file as JSON lines
+    def write(self):
+        if self.profile_stage in self.stages:
+            self.writeProfile()
+
+        run = {'script': os.path.basename(sys.argv[0]), 'pid': os.getpid(), 'time': time.time()}
+        for s in self.stages.values():
+            s['items_per_sec'] = s['items'] / s['wall'] if s['items'] is not None and s['wall'] > 0 else None
+            logger.warning(f'Stage {s["stage"]}: wall {s["wall"]:.2f}s cpu {s["cpu"]:.2f}s calls {s["calls"]} ' +
+                           f'items {s["items"]} items/sec {s["items_per_sec"]} peak RSS {s["peak_rss_mb"]:.1f}MB ' +
+                           f'(+{s["rss_growth_mb"]:.1f}MB)')
+
+        if self.metrics_file is not None and len(self.stages) > 0:
+            with open(self.metrics_file, 'a') as f:
+                for s in self.stages.values():
+                    f.write(json.dumps({**run, **s}) + '\n')
+            logger.warning(f'Written metrics to {self.metrics_file}')
+
+
+def maxRSS():
+    '''
+        Return the peak resident set size of the process (and of its terminated children)
+
+                Returns:
+                        float: peak resident set size in MB
+    '''
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def currentRSS():
+    '''
+        Return the current resident set size of the process, where /proc is available (e.g. Linux)
+
+                Returns:
+                        float: resident set size in MB, or None if it cannot be read
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+'''
+    Peak of the resident set size of the process during some intervals (e.g. stages), possibly nested.
+    A background thread samples the resident set size every interval seconds while any interval is
+    open; where the current resident set size cannot be read, the peak of the process is used instead,
+    hence an interval is attributed only the growth of the peak of the process while it is open.
+'''
+
+
+class RSSSampler:
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.open = {}  # Open intervals, indexed by their id
+        self.lock = threading.Lock()
+        self.pid = None  # Process the thread runs in (processes forked from it have to start their own)
+
+    # Open an interval, returning the object its start and peak resident set size (MB) are held by
+    def start(self):
+        rss = currentRSS()
+        record = SimpleNamespace(start=rss if rss is not None else maxRSS(), peak=None)
+        record.peak = record.start
+        if rss is not None:
+            with self.lock:
+                self.open[id(record)] = record
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    threading.Thread(target=self.sample, daemon=True).start()
+        return record
+
+    def stop(self, record):
+        with self.lock:
+            self.open.pop(id(record), None)
+        rss = currentRSS()
+        record.peak = max(record.peak, rss if rss is not None else maxRSS())
+
+    def sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if len(self.open) == 0:
+                    continue
+                rss = currentRSS()
+                for record in self.open.values():
+                    record.peak = max(record.peak, rss)
+
+
+def addMetricsArguments(argp):
+    '''
+        Add the options of metrics to the arguments of a script
+
+                Parameters:
+                        argp (ArgParser): argument parser of the script
+    '''
+    argp.add('--metrics_file', required=False, type=str, env_var='METRICS_FILE',
+             help='file the time, memory and throughput of every stage are appended to, as JSON lines')
+    argp.add('--profile_stage', required=False, type=str, env_var='PROFILE_STAGE',
+             help='name of a stage to profile')
+    argp.add('--profile_mode', required=False, type=str, default='cprofile', choices=['cprofile', 'tracemalloc'],
+             env_var='PROFILE_MODE',
+             help='profiler of the profiled stage: cprofile (time by function) or tracemalloc (memory by line)')
+
+
+# Resident set size sampler and metrics of the running script
+rssSampler = RSSSampler()
+metrics = Metrics()
@@ -0,0 +1,81 @@
+'''
+    Parsing of the rows of a CouchDB view JSON, in batches of (key, tags, tokens) tuples.
+    The rows array is streamed with the C backend of ijson when it is installed, and with
+    json_stream (pure Python) otherwise.
+'''
+
+# Backends of ijson that are C-accelerated
+ijsonFastBackends = ['yajl2_c', 'yajl2_cffi']
+
+
+def parserBackend(backend='auto'):
+    '''
+        Choose the backend parsing the rows
+
+                Parameters:
+                        backend (String): auto (ijson if its C backend is installed, json_stream otherwise),
+                            ijson or json_stream
+
+                Returns:
+                        String: ijson or json_stream
+    '''
+    if backend == 'json_stream':
+        return backend
+    try:
+        import ijson
+    except ImportError:
+        if backend == 'ijson':
+            raise
+        return 'json_stream'
+    return 'ijson' if backend == 'ijson' or ijson.backend in ijsonFastBackends else 'json_stream'
+
+
+def rowBatches(corpus_query_file, batch_size=10000, backend='auto'):
+    '''
+        Read the rows of a CouchDB view JSON file in batches
+
+                Parameters:
+                        corpus_query_file (String): input query file
+                        batch_size (int): n. of rows of every batch
+                        backend (String): parser backend (see parserBackend)
+
+                Returns:
+                        Generator(List(Tuple(List, String, String))): batches of (key, tags, tokens) tuples
+    '''
+    batch = []
+    for row in iterRows(corpus_query_file, parserBackend(backend)):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def iterRows(corpus_query_file, backend):
+    if backend == 'ijson':
+        import ijson
+        with open(corpus_query_file, 'rb') as f:
+            for row in ijson.items(f, 'rows.item'):
+                yield (row['key'], row['value']['tags'], row['value']['tokens'])
+    else:
+        import json_stream
+        with open(corpus_query_file, 'r') as f:
+            for row in json_stream.load(f, persistent=False)['rows'].persistent():
+                v = row['value']
+                yield (list(row['key']), v['tags'], v['tokens'])
+
+
+def filterRows(batch, tm_mintokens_perdocument):
+    '''
+        Discard the rows with fewer tokens than a threshold (tokens are counted as characters of the
+        tokens string)
+
+                Parameters:
+                        batch (List(Tuple)): (key, tags, tokens) rows
+                        tm_mintokens_perdocument (int): minimum length of the tokens string
+
+                Returns:
+                        List(Tuple): rows kept
+    '''
+    return [row for row in batch if len(row[2]) >= tm_mintokens_perdocument]
@@ -0,0 +1,320 @@
+'''
+    Benchmarks of the stages of the pipeline on synthetic data: time, CPU time and memory of every
+    stage are written to a JSON file, and compared against a baseline (as written by a previous run)
+    to catch regressions. Runs offline and on CPU only: stages that need NLTK resources are skipped
+    if the resources are not installed.
+'''
+
+import sys
+
+sys.path.append('../src')
+
+from logger import logger
+from AdoDocument import AdoDocument, nltkResources, termCache
+from AdoCorpus import AdoCorpus
+from buildCorpus import retrieveDocuments, streamDocuments
+from computeSurface import computeSurface, updateSurface
+from surface_lib import accumulateKDE
+from tuples import SurfaceGeometry
+from export_lib import exportSurfaceToGrid, exportTopicLocationToGeoJSON, importTopicLocationFromGeoJSON
+from buildDynTopics import topicLocations
+from metrics_lib import rssSampler
+from synthetic_lib import syntheticQueryRows, writeSyntheticQuery, syntheticTopicLocations, SyntheticTopicModel, \
+    syntheticTopicsOverTime
+import configargparse, json, os, platform, shutil, tempfile, time, tracemalloc
+import numpy as np
+
+
+def nltkAvailable():
+    '''
+        Check whether the NLTK resources needed to extract terms are installed (without downloading them)
+
+                Returns:
+                        bool: True if the resources can be loaded
+    '''
+    try:
+        import nltk
+    except ImportError:
+        return False
+    if os.environ.get('NLTK_DIR') is not None and os.environ['NLTK_DIR'] not in nltk.data.path:
+        nltk.data.path.append(os.environ['NLTK_DIR'])
+    try:
+        for resource_name in nltkResources:
+            nltk.data.find(resource_name)
+    except LookupError:
+        return False
+    return True
+
+
+def measure(stage, repeat, memory):
+    '''
+        Run a benchmark stage repeat times, recording the best wall and CPU times, and (once more, since
+        tracing slows it down) the peak of memory allocated by Python
+
+                Parameters:
+                        stage (Function): stage to run, returning the n. of items it processed
+                        repeat (int): n. of timed runs
+                        memory (bool): whether to trace memory allocations
+
+                Returns:
+                        Dict: wall and CPU seconds, items, items per second, peak traced memory (MB), and
+                            peak resident set size of the process during the runs and its growth over the
+                            one at their start (MB)
+    '''
+    wall = []
+    cpu = []
+    rss = []
+    for i in range(repeat):
+        (wall0, cpu0) = (time.perf_counter(), time.process_time())
+        rss.append(rssSampler.start())
+        items = stage()
+        rssSampler.stop(rss[-1])
+        wall.append(time.perf_counter() - wall0)
+        cpu.append(time.process_time() - cpu0)
+
+    result = {'wall': min(wall), 'cpu': min(cpu), 'items': items,
+              'items_per_sec': items / min(wall) if min(wall) > 0 else None}
+    if memory:
+        tracemalloc.start()
+        stage()
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+        tracemalloc.stop()
+    result['peak_rss_mb'] = max(r.peak for r in rss)
+    result['rss_growth_mb'] = max(r.peak - r.start for r in rss)
+    return result
+
+
+def checkSurfaceUpdate(base_locs, locs, settings, state_file):
+    '''
+        Check that an incremental surface update equals the KDE computed from scratch on the same (pinned)
+        grid geometry, and log how much it differs from the surface computed from scratch on the geometry
+        of the updated locations
+
+                Parameters:
+                        base_locs (List(TopicLocation)): locations of the saved surface
+                        locs (List(TopicLocation)): locations the saved surface is updated with
+                        settings (Namespace): benchmark settings
+                        state_file (String): state file the surface of base_locs is saved to (and copied to
+                            state_file.base.npz)
+    '''
+    updateSurface(base_locs, settings.n_rows, settings.max_dist, 1, state_file)
+    shutil.copy(state_file, f'{state_file}.base.npz')
+    (gz, g) = updateSurface(locs, settings.n_rows, settings.max_dist, 1, state_file)
+
+    with np.load(state_file) as state:
+        geom = SurfaceGeometry(*[state[k].item() for k in SurfaceGeometry._fields])
+        expected = accumulateKDE(np.zeros([geom.n_rows, geom.n_cols]), geom, state['x'], state['y'], state['z'])
+    if not np.allclose(gz, expected):
+        raise ValueError(f'Incremental surface differs from the full one in {int((~np.isclose(gz, expected)).sum())} cells')
+
+    # The grids differ in cell size, hence they are compared at the cells of the smaller one
+    (full, full_g) = computeSurface(locs, settings.n_rows, settings.max_dist, 1)
+    rows = np.minimum((np.arange(full.shape[0]) * full_g / g).round().astype(np.int64), gz.shape[0] - 1)
+    cols = np.minimum((np.arange(full.shape[1]) * full_g / g).round().astype(np.int64), gz.shape[1] - 1)
+    deviation = np.abs(gz[rows[:, np.newaxis], cols[np.newaxis, :]] - full).max() / max(full.max(), 1e-12)
+    logger.warning(f'Incremental surface deviates from the full one by {deviation:.2%} of its maximum')
+
+
+def benchmarkStages(settings, work_dir):
+    '''
+        Generate the synthetic data and return the benchmark stages
+
+                Parameters:
+                        settings (Namespace): benchmark settings
+                        work_dir (String): directory holding the files written by benchmarks
+
+                Returns:
+                        Dict(String, Function): stages, by name
+    '''
+    query_file = f'{work_dir}/query.json'
+    writeSyntheticQuery(query_file, settings.n_documents, settings.n_conversations, settings.tokens_per_document,
+                        settings.vocabulary_size, settings.seed)
+    rows = [(row['key'][3], row['value']['tags'], row['value']['tokens'])
+            for row in syntheticQueryRows(settings.n_documents, settings.n_conversations,
+                                          settings.tokens_per_document, settings.vocabulary_size,
+                                          seed=settings.seed)]
+    documents = [AdoDocument(*row) for row in rows]
+    locs = syntheticTopicLocations(settings.n_timestamps, settings.n_topics, seed=settings.seed)
+    surf = computeSurface(locs, settings.n_rows, settings.max_dist, 1)
+
+    def parse():
+        return sum(1 for d in streamDocuments(query_file, 0, 'true', parser_backend=settings.parser_backend))
+
+    # Documents grouped by conversation, as held in memory by retrieveDocuments
+    def documentsBuild():
+        conversations = {}
+        for (k, tags, tokens) in rows:
+            if k in conversations:
+                conversations[k].add(tags, tokens)
+            else:
+                conversations[k] = AdoDocument(k, tags, tokens)
+        return len(rows)
+
+    # Stages extracting terms start with an empty term cache, so that every run converts all the tokens
+    def retrieve():
+        termCache.clear()
+        return len(retrieveDocuments(query_file, 0, 'true', parser_backend=settings.parser_backend))
+
+    def tokens2terms():
+        termCache.clear()
+        for row in rows:
+            AdoDocument(*row).tokens2terms()
+        return len(rows)
+
+    def corpusSave():
+        corpus = AdoCorpus(f'{work_dir}/bench.corpus')
+        for d in documents:
+            corpus.save(d)
+        corpus.close()
+        return len(documents)
+
+    def corpusIterate():
+        return sum(1 for d in AdoCorpus(f'{work_dir}/bench.corpus'))
+
+    def surface():
+        return computeSurface(locs, settings.n_rows, settings.max_dist, 1)[0].size
+
+    # Surface of all time slices but the last, updated with the last one, laid out as buildDynTopics does:
+    # the last slice is placed in a new column with the unit of Y of the previous ones
+    topic_model = SyntheticTopicModel(settings.n_topics, seed=settings.seed)
+    topics_over_time = syntheticTopicsOverTime(settings.n_timestamps, settings.n_topics, seed=settings.seed)
+    last = settings.n_timestamps - 1
+    (base_locs, y_unit) = topicLocations(topic_model, topics_over_time[topics_over_time['Timestamp'] < last],
+                                         [t for t in topics_over_time['Timestamp'].to_list() if t < last])
+    update_locs = base_locs + topicLocations(topic_model, topics_over_time[topics_over_time['Timestamp'] == last],
+                                             topics_over_time['Timestamp'].to_list(), y_unit)[0]
+    state_file = f'{work_dir}/bench.surface.state.npz'
+    checkSurfaceUpdate(base_locs, update_locs, settings, state_file)
+
+    def surfaceUpdate():
+        shutil.copy(f'{state_file}.base.npz', state_file)
+        updateSurface(update_locs, settings.n_rows, settings.max_dist, 1, state_file)
+        return len(update_locs)
+
+    def gridExport():
+        exportSurfaceToGrid(surf, f'{work_dir}/bench.surface.asc')
+        return surf[0].size
+
+    def geojsonExport():
+        exportTopicLocationToGeoJSON(locs, f'{work_dir}/bench.topiclocation.geojson', 1, 1)
+        return len(locs)
+
+    def geojsonImport():
+        return len(importTopicLocationFromGeoJSON(f'{work_dir}/bench.topiclocation.geojson'))
+
+    stages = {'parse': parse, 'documents_build': documentsBuild}
+    if nltkAvailable():
+        stages['retrieve_documents'] = retrieve
+        stages['tokens2terms'] = tokens2terms
+    else:
+        logger.warning('NLTK resources not installed, skipping retrieve_documents and tokens2terms')
+    stages.update({'corpus_save': corpusSave, 'corpus_iterate': corpusIterate, 'compute_surface': surface,
+                   'surface_update': surfaceUpdate, 'export_grid': gridExport, 'geojson_export': geojsonExport, 'geojson_import': geojsonImport})
+    return stages
+
+
+def compareResults(results, baseline, tolerance):
+    '''
+        Compare benchmark results against a baseline
+
+                Parameters:
+                        results (Dict): stage results, as returned by measure
+                        baseline (Dict): baseline stage results
+                        tolerance (float): relative increase of wall time or peak memory considered a regression
+
+                Returns:
+                        List(String): regressions found
+    '''
+    regressions = []
+    for (name, result) in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('wall', 'peak_mb'):
+            if result.get(metric) is None or baseline[name].get(metric) is None or baseline[name][metric] <= 0:
+                continue
+            ratio = result[metric] / baseline[name][metric]
+            logger.warning(f'{name} {metric}: {result[metric]:.4f} (baseline {baseline[name][metric]:.4f}, x{ratio:.2f})')
+            if ratio > 1 + tolerance:
+                regressions.append(f'{name} {metric} x{ratio:.2f}')
+    return regressions
+
+
+def dataSettings(settings):
+    # Settings the results depend on, that have to match the ones of the baseline
+    return {k: v for (k, v) in vars(settings).items()
+            if k not in ('output_file', 'baseline_file', 'tolerance', 'stages', 'work_dir')}
+
+
+def main():
+    argp = configargparse.ArgParser()
+    argp.add('--output_file', required=True, type=str, env_var='BENCHMARK_FILE',
+             help='JSON file benchmark results are written to')
+    argp.add('--baseline_file', required=False, type=str, env_var='BENCHMARK_BASELINE_FILE',
+             help='JSON file of a previous run to compare results against')
+    argp.add('--tolerance', required=False, type=float, default=0.2, env_var='BENCHMARK_TOLERANCE',
+             help='relative increase of time or memory over the baseline considered a regression')
+    argp.add('--stages', required=False, nargs='+', env_var='BENCHMARK_STAGES',
+             help='stages to run (all by default)')
+    argp.add('--repeat', required=False, type=int, default=3, env_var='BENCHMARK_REPEAT',
+             help='n. of timed runs of every stage (the best one is recorded)')
+    argp.add('--memory', required=False, type=str, default='true', env_var='BENCHMARK_MEMORY',
+             help='flag to trace the peak memory of every stage (in a further run)')
+    argp.add('--work_dir', required=False, type=str, env_var='BENCHMARK_WORK_DIR',
+             help='directory holding the files written by benchmarks (defaults to a temporary directory)')
+    argp.add('--n_documents', required=False, type=int, default=20000, env_var='BENCHMARK_N_DOCUMENTS',
+             help='n. of synthetic documents (view rows)')
+    argp.add('--n_conversations', required=False, type=int, default=5000, env_var='BENCHMARK_N_CONVERSATIONS',
+             help='n. of conversations of synthetic documents')
+    argp.add('--tokens_per_document', required=False, type=int, default=20, env_var='BENCHMARK_TOKENS_PER_DOCUMENT',
+             help='average n. of tokens of synthetic documents')
+    argp.add('--vocabulary_size', required=False, type=int, default=5000, env_var='BENCHMARK_VOCABULARY_SIZE',
+             help='n. of distinct words of synthetic documents')
+    argp.add('--n_timestamps', required=False, type=int, default=50, env_var='BENCHMARK_N_TIMESTAMPS',
+             help='n. of timestamps of synthetic topic locations')
+    argp.add('--n_topics', required=False, type=int, default=200, env_var='BENCHMARK_N_TOPICS',
+             help='n. of topics of synthetic topic locations')
+    argp.add('--n_rows', required=False, type=int, default=300, env_var='BENCHMARK_N_ROWS',
+             help='n. of rows of the surface grid')
+    argp.add('--max_dist', required=False, type=float, default=0.9, env_var='BENCHMARK_MAX_DIST',
+             help='max distance the KDE uses')
+    argp.add('--parser_backend', required=False, type=str, default='auto', choices=['auto', 'ijson', 'json_stream'],
+             env_var='PARSER_BACKEND',
+             help='parser of the query file: ijson, json_stream, or auto (ijson if its C backend is installed)')
+    argp.add('--seed', required=False, type=int, default=0, env_var='BENCHMARK_SEED',
+             help='seed of the synthetic data generator')
+
+    settings = argp.parse_known_args()[0]
+    results = {}
+    with tempfile.TemporaryDirectory(dir=settings.work_dir) as work_dir:
+        stages = benchmarkStages(settings, work_dir)
+        for (name, stage) in stages.items():
+            if settings.stages is not None and name not in settings.stages:
+                continue
+            results[name] = measure(stage, settings.repeat, str(settings.memory).lower() == 'true')
+            logger.warning(f'{name}: {json.dumps(results[name])}')
+
+    with open(settings.output_file, 'w') as f:
+        json.dump({
+            'settings': dataSettings(settings),
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'machine': platform.machine(), 'cpus': os.cpu_count()},
+            'stages': results
+        }, f, indent=2)
+    logger.warning(f'Written {settings.output_file}')
+
+    if settings.baseline_file is not None:
+        with open(settings.baseline_file, 'r') as f:
+            baseline = json.load(f)
+        if baseline['settings'] != json.loads(json.dumps(dataSettings(settings))):
+            logger.warning(f'Settings differ from the ones of {settings.baseline_file}')
+        regressions = compareResults(results, baseline['stages'], settings.tolerance)
+        if len(regressions) > 0:
+            logger.error(f'Regressions: {", ".join(regressions)}')
+            sys.exit(1)
+        logger.warning('No regressions')
+
+
+if __name__ == '__main__':
+    logger.warning(f'Started {__file__}')
+    main()
+    logger.warning(f'ended')
@@ -0,0 +1,314 @@
+import math, numpy as np
+from tuples import SurfaceGeometry
+from tqdm import tqdm
+from multiprocessing import Pool
+
+'''
+    Kernel Density Estimation of topic locations over a regular grid.
+    Every point only contributes to the cells inside its (warped) Quartic kernel footprint,
+    hence only those cells are visited.
+'''
+
+
+def surfaceGeometry(x, y, t, n_rows, max_dist):
+    '''
+    Compute the geometry of the surface grid
+    :param x (numpy.array): X coordinates of the locations
+    :param y (numpy.array): Y coordinates of the locations
+    :param t (List(int)): timestamps of the locations
+    :param n_rows (int): n. of rows of the surface
+    :param max_dist (float): maximum distance for KDE expressed in distance between intervals
+    :return: (SurfaceGeometry) geometry of the grid
+    '''
+    # Computes the cell size based on the number of unique timestamps
+    g = (np.max(y) - np.min(y)) / n_rows
+    n_cols = int((np.max(x) - np.min(x)) / g)
+    n = len(x)
+    n_t = len(set(t))
+
+    return SurfaceGeometry(
+        n_rows=n_rows,
+        n_cols=n_cols,
+        g=g,
+        # Ratio of "stretching" of x distance
+        x_warp=n / (n_t ** 2),
+        # Max distance for KDE expressed in surface units
+        max_dist_u=max_dist * g * (n_cols / n_t)
+    )
+
+
+def kdeQuartic(d, h, z):
+    '''
+    Compute the Quartic kernel Density Estimator of value z
+    :param d (numpy.array): distances of z from the grid cells
+    :param h (float): max distance that affects the KDE computation
+    :param z (float): value to calculate the KDE of
+    :return: (numpy.array) KDE values (0 where d is greater than h)
+    '''
+    return np.where(d <= h, ((15 / 16) * (1 - (d / h) ** 2) ** 2) * z, 0.0)
+
+
+def warpedEuclidianDist(dx, dy, yx):
+    '''
+    Compute warped Euclidean distances given the X and Y differences between points
+    :param dx (numpy.array): X differences
+    :param dy (numpy.array): Y differences
+    :param yx (float): factor to "stretch" the X distance of
+    :return: (numpy.array) Warped Euclidean distances
+    '''
+    return np.sqrt((dx ** 2) / yx + dy ** 2)
+
+
+def kernelFootprint(geom, x, y):
+    '''
+    Compute the range of grid cells that can be reached by the kernel of every point
+    :param geom (SurfaceGeometry): geometry of the grid
+    :param x (numpy.array): X coordinates of the points
+    :param y (numpy.array): Y coordinates of the points
+    :return: (numpy.array, numpy.array, numpy.array, numpy.array): first row, last row (excluded),
+        first column, last column (excluded) of the footprint of every point
+    '''
+    # Along X the kernel reaches farther, since X differences are shrunk by the warp
+    x_reach = geom.max_dist_u * math.sqrt(geom.x_warp)
+    y_reach = geom.max_dist_u
+    r0 = np.clip(np.floor((y - y_reach) / geom.g), 0, geom.n_rows).astype(np.int64)
+    r1 = np.clip(np.ceil((y + y_reach) / geom.g) + 1, 0, geom.n_rows).astype(np.int64)
+    c0 = np.clip(np.floor((x - x_reach) / geom.g), 0, geom.n_cols).astype(np.int64)
+    c1 = np.clip(np.ceil((x + x_reach) / geom.g) + 1, 0, geom.n_cols).astype(np.int64)
+    return (r0, r1, c0, c1)
+
+
+def accumulateKDE(gz, geom, x, y, z, row0=0, col0=0, progress=False):
+    '''
+    Add the KDE of a set of points to a (window of the) surface grid. Only the cells within the
+    kernel footprint of every point are computed.
+    :param gz (numpy.array): 2D array the KDE values are added to (updated in place)
+    :param geom (SurfaceGeometry): geometry of the whole grid
+    :param x (numpy.array): X coordinates of the points
+    :param y (numpy.array): Y coordinates of the points
+    :param z (numpy.array): values of the points
+    :param row0 (int): grid row of the first row of gz
+    :param col0 (int): grid column of the first column of gz
+    :param progress (bool): whether to show a progress bar
+    :return: (numpy.array) gz
+    '''
+    (r0, r1, c0, c1) = kernelFootprint(geom, x, y)
+    r0 = np.maximum(r0, row0)
+    r1 = np.minimum(r1, row0 + gz.shape[0])
+    c0 = np.maximum(c0, col0)
+    c1 = np.minimum(c1, col0 + gz.shape[1])
+
+    for i in tqdm(range(len(x)), disable=not progress):
+        if r0[i] >= r1[i] or c0[i] >= c1[i]:
+            continue
+        d = warpedEuclidianDist(
+            (np.arange(c0[i], c1[i]) * geom.g - x[i])[np.newaxis, :],
+            (np.arange(r0[i], r1[i]) * geom.g - y[i])[:, np.newaxis],
+            geom.x_warp
+        )
+        gz[r0[i] - row0:r1[i] - row0, c0[i] - col0:c1[i] - col0] += kdeQuartic(d, geom.max_dist_u, z[i])
+    return gz
+
+
+def accumulateKDESweep(gzs, geoms, x, y, z, progress=False):
+    '''
+    Add the KDE of a set of points to many surface grids that share their cells, but not the max distance
+    of their kernels. The distances of every point from the cells within the largest kernel footprint
+    are computed once, and shared by the kernels of all the grids.
+    :param gzs (List(numpy.array)): 2D arrays the KDE values are added to (updated in place)
+    :param geoms (List(SurfaceGeometry)): geometries of the grids, differing in max_dist_u only
+    :param x (numpy.array): X coordinates of the points
+    :param y (numpy.array): Y coordinates of the points
+    :param z (numpy.array): values of the points
+    :param progress (bool): whether to show a progress bar
+    :return: (List(numpy.array)) gzs
+    '''
+    widest = max(geoms, key=lambda geom: geom.max_dist_u)
+    (r0, r1, c0, c1) = kernelFootprint(widest, x, y)
+    # Footprints of every grid, within the widest one
+    footprints = [kernelFootprint(geom, x, y) for geom in geoms]
+
+    for i in tqdm(range(len(x)), disable=not progress):
+        if r0[i] >= r1[i] or c0[i] >= c1[i]:
+            continue
+        d = warpedEuclidianDist(
+            (np.arange(c0[i], c1[i]) * widest.g - x[i])[np.newaxis, :],
+            (np.arange(r0[i], r1[i]) * widest.g - y[i])[:, np.newaxis],
+            widest.x_warp
+        )
+        for (gz, geom, (fr0, fr1, fc0, fc1)) in zip(gzs, geoms, footprints):
+            gz[fr0[i]:fr1[i], fc0[i]:fc1[i]] += kdeQuartic(
+                d[fr0[i] - r0[i]:fr1[i] - r0[i], fc0[i] - c0[i]:fc1[i] - c0[i]], geom.max_dist_u, z[i])
+    return gzs
+
+
+def surfaceTiles(geom, tile_size):
+    '''
+    Split the grid in square tiles
+    :param geom (SurfaceGeometry): geometry of the grid
+    :param tile_size (int): n. of rows and columns of every tile
+    :return: (List(Tuple(int, int, int, int))): first row, last row (excluded), first column and
+        last column (excluded) of every tile
+    '''
+    return [(r, min(r + tile_size, geom.n_rows), c, min(c + tile_size, geom.n_cols))
+            for r in range(0, geom.n_rows, tile_size)
+            for c in range(0, geom.n_cols, tile_size)]
+
+
+def tilePoints(footprint, tile):
+    '''
+    Select the points whose kernel footprint intersects a tile
+    :param footprint (Tuple): footprints of the points, as returned by kernelFootprint
+    :param tile (Tuple(int, int, int, int)): tile as returned by surfaceTiles
+    :return: (numpy.array) indices of the points within reach of the tile
+    '''
+    (r0, r1, c0, c1) = footprint
+    return np.nonzero((r0 < tile[1]) & (r1 > tile[0]) & (c0 < tile[3]) & (c1 > tile[2]))[0]
+
+
+def computeTile(task):
+    '''
+    Compute the KDE of a tile of the grid. If a grid file is given, the tile is written into it,
+    otherwise it is returned
+    :param task (Tuple): geometry, tile, X, Y and values of the points within reach of the tile,
+        rescaling factor of Z values and grid file name (or None)
+    :return: (Tuple(Tuple, numpy.array)): tile and its values (None if written to the grid file)
+    '''
+    (geom, tile, x, y, z, z_scale, grid_file) = task
+    tz = np.zeros([tile[1] - tile[0], tile[3] - tile[2]])
+    accumulateKDE(tz, geom, x, y, z, row0=tile[0], col0=tile[2])
+    tz *= z_scale
+
+    if grid_file is None:
+        return (tile, tz)
+
+    gz = np.load(grid_file, mmap_mode='r+')
+    gz[tile[0]:tile[1], tile[2]:tile[3]] = tz
+    gz.flush()
+    del gz
+    return (tile, None)
+
+
+def computeTiledKDE(gz, geom, x, y, z, z_scale, tile_size, workers, grid_file=None):
+    '''
+    Compute the KDE of a set of points tile by tile, using a pool of processes. Every tile is sent
+    only the points within kernel reach of it.
+    :param gz (numpy.array): 2D array to write the (rescaled) KDE values into
+    :param geom (SurfaceGeometry): geometry of the grid
+    :param x (numpy.array): X coordinates of the points
+    :param y (numpy.array): Y coordinates of the points
+    :param z (numpy.array): values of the points
+    :param z_scale (float): rescaling factor of Z values
+    :param tile_size (int): n. of rows and columns of every tile
+    :param workers (int): n. of processes to use
+    :param grid_file (String): .npy file gz is memory-mapped to (tiles are written directly by the workers),
+        or None if gz is held in memory
+    :return: (numpy.array) gz
+    '''
+    footprint = kernelFootprint(geom, x, y)
+    tiles = surfaceTiles(geom, tile_size)
+
+    def tasks():
+        for tile in tiles:
+            i = tilePoints(footprint, tile)
+            yield (geom, tile, x[i], y[i], z[i], z_scale, grid_file)
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            for (tile, tz) in tqdm(pool.imap_unordered(computeTile, tasks()), total=len(tiles)):
+                if tz is not None:
+                    gz[tile[0]:tile[1], tile[2]:tile[3]] = tz
+    else:
+        for (tile, tz) in tqdm(map(computeTile, tasks()), total=len(tiles)):
+            if tz is not None:
+                gz[tile[0]:tile[1], tile[2]:tile[3]] = tz
+    return gz
+
+
+def dirtyWindows(geom, footprint, tile_size):
+    '''
+    Compute the windows of the grid reached by the kernels of some points: within every tile reached by
+    any of them, the bounding box of their footprints
+    :param geom (SurfaceGeometry): geometry of the grid
+    :param footprint (Tuple): footprints of the points, as returned by kernelFootprint
+    :param tile_size (int): n. of rows and columns of every tile
+    :return: (List(Tuple(int, int, int, int))): first row, last row (excluded), first column and
+        last column (excluded) of every window
+    '''
+    (r0, r1, c0, c1) = footprint
+    windows = []
+    for tile in surfaceTiles(geom, tile_size):
+        i = tilePoints(footprint, tile)
+        if len(i) > 0:
+            windows.append((max(tile[0], int(r0[i].min())), min(tile[1], int(r1[i].max())),
+                            max(tile[2], int(c0[i].min())), min(tile[3], int(c1[i].max()))))
+    return windows
+
+
+def patchChunk(task):
+    '''
+    Compute the KDE of some points over their kernel footprints (used by the processes of kernelPatches)
+    :param task (Tuple): geometry, X, Y and values of the points
+    :return: (numpy.array) KDE values of the footprints of the points, row by row, one after the other
+    '''
+    (geom, x, y, z) = task
+    (r0, r1, c0, c1) = kernelFootprint(geom, x, y)
+    patches = []
+    for i in range(len(x)):
+        if r0[i] >= r1[i] or c0[i] >= c1[i]:
+            continue
+        d = warpedEuclidianDist(
+            (np.arange(c0[i], c1[i]) * geom.g - x[i])[np.newaxis, :],
+            (np.arange(r0[i], r1[i]) * geom.g - y[i])[:, np.newaxis],
+            geom.x_warp
+        )
+        patches.append(kdeQuartic(d, geom.max_dist_u, z[i]).ravel())
+    return np.concatenate(patches) if len(patches) > 0 else np.zeros(0)
+
+
+def kernelPatches(geom, x, y, z, workers=1):
+    '''
+    Compute the KDE of every point over its kernel footprint (its contribution to the grid)
+    :param geom (SurfaceGeometry): geometry of the grid
+    :param x (numpy.array): X coordinates of the points
+    :param y (numpy.array): Y coordinates of the points
+    :param z (numpy.array): values of the points
+    :param workers (int): n. of processes to use
+    :return: (Tuple, numpy.array, numpy.array): footprints of the points, as returned by kernelFootprint,
+        offsets of the KDE values of every point in the flat array holding them, and the flat array
+    '''
+    footprint = kernelFootprint(geom, x, y)
+    (r0, r1, c0, c1) = footprint
+    offsets = np.zeros(len(x) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.maximum(r1 - r0, 0) * np.maximum(c1 - c0, 0))
+    chunks = np.array_split(np.arange(len(x)), max(1, min(workers, len(x))))
+    tasks = [(geom, x[i], y[i], z[i]) for i in chunks]
+    if workers > 1:
+        with Pool(workers) as pool:
+            patches = np.concatenate(pool.map(patchChunk, tasks))
+    else:
+        patches = np.concatenate([patchChunk(task) for task in tasks])
+    return (footprint, offsets, patches)
+
+
+def sumPatches(gz, footprint, offsets, patches, windows):
+    '''
+    Recompute some windows of the grid as the sum of the KDE of the points within reach of them, read
+    from their footprints; points are added in order, as accumulateKDE does, hence windows get the
+    same values. The other cells are left untouched
+    :param gz (numpy.array): 2D array of (not rescaled) KDE values, updated in place
+    :param footprint (Tuple): footprints of the points, as returned by kernelFootprint
+    :param offsets (numpy.array): offsets of the KDE values of every point, as returned by kernelPatches
+    :param patches (numpy.array): KDE values of all the points, as returned by kernelPatches
+    :param windows (List(Tuple(int, int, int, int))): windows, as returned by dirtyWindows
+    :return: (numpy.array) gz
+    '''
+    (r0, r1, c0, c1) = footprint
+    for window in windows:
+        gz[window[0]:window[1], window[2]:window[3]] = 0
+        for i in tilePoints(footprint, window):
+            patch = patches[offsets[i]:offsets[i + 1]].reshape(r1[i] - r0[i], c1[i] - c0[i])
+            (wr0, wr1) = (max(r0[i], window[0]), min(r1[i], window[1]))
+            (wc0, wc1) = (max(c0[i], window[2]), min(c1[i], window[3]))
+            gz[wr0:wr1, wc0:wc1] += patch[wr0 - r0[i]:wr1 - r0[i], wc0 - c0[i]:wc1 - c0[i]]
+    return gz
@@ -0,0 +1,175 @@
+import json, numpy as np
+from tuples import TopicLocation
+
+'''
+    Generation of synthetic data, in configurable sizes, for benchmarks: CouchDB view JSON files
+    in the format of data/datasample.json, sets of topic locations as built by buildDynTopics, and
+    topic models and topic frequencies to lay out topics with buildDynTopics
+'''
+
+# Syllables the synthetic words are made of
+syllables = ['ba', 'ce', 'di', 'fo', 'gu', 'la', 'me', 'ni', 'po', 'ru', 'sa', 'te', 'vi', 'zo', 'ka', 'ly']
+
+
+def syntheticVocabulary(vocabulary_size, seed=0):
+    '''
+        Generate a vocabulary of distinct, alphabetic words
+
+                Parameters:
+                        vocabulary_size (int): n. of words
+                        seed (int): seed of the random generator
+
+                Returns:
+                        List(String): words
+    '''
+    rng = np.random.default_rng(seed)
+    words = []
+    for i in range(vocabulary_size):
+        # The index (in base len(syllables)) makes words distinct, a random syllable varies their length
+        word = ''
+        j = i
+        while True:
+            word += syllables[j % len(syllables)]
+            j //= len(syllables)
+            if j == 0:
+                break
+        words.append(word + syllables[rng.integers(len(syllables))])
+    return words
+
+
+def syntheticQueryRows(n_documents, n_conversations, tokens_per_document=20, vocabulary_size=5000,
+                       hashtag_fraction=0.1, seed=0):
+    '''
+        Generate the rows of a CouchDB view, as read by buildCorpus. Rows of the same conversation are
+        spread across the whole view, and word frequencies follow a Zipf-like distribution
+
+                Parameters:
+                        n_documents (int): n. of rows (tweets)
+                        n_conversations (int): n. of conversations the rows belong to
+                        tokens_per_document (int): average n. of tokens of every row
+                        vocabulary_size (int): n. of distinct words
+                        hashtag_fraction (float): fraction of rows with a hashtag
+                        seed (int): seed of the random generator
+
+                Returns:
+                        Generator(Dict): rows, with id, key and value
+    '''
+    rng = np.random.default_rng(seed)
+    vocabulary = syntheticVocabulary(vocabulary_size, seed)
+    p = 1.0 / np.arange(1, vocabulary_size + 1)
+    p /= p.sum()
+
+    for i in range(n_documents):
+        doc_id = f'{1500000000000000000 + i}'
+        conversation_id = f'{1000000000000000000 + rng.integers(n_conversations)}'
+        n_tokens = max(1, int(rng.poisson(tokens_per_document)))
+        tokens = [vocabulary[w] for w in rng.choice(vocabulary_size, n_tokens, p=p)]
+        tags = vocabulary[rng.integers(vocabulary_size)] if rng.random() < hashtag_fraction else ''
+        yield {'id': doc_id,
+               'key': [2022, 5, 1 + i * 28 // n_documents, conversation_id, f'{rng.integers(1 << 30)}', doc_id],
+               'value': {'tags': tags, 'tokens': '|'.join(tokens)}}
+
+
+def writeSyntheticQuery(out_file, n_documents, n_conversations, tokens_per_document=20, vocabulary_size=5000,
+                        seed=0):
+    '''
+        Write a synthetic CouchDB view JSON file, one row per line
+
+                Parameters:
+                        out_file (String): output JSON file
+                        n_documents (int): n. of rows (tweets)
+                        n_conversations (int): n. of conversations the rows belong to
+                        tokens_per_document (int): average n. of tokens of every row
+                        vocabulary_size (int): n. of distinct words
+                        seed (int): seed of the random generator
+    '''
+    with open(out_file, 'w') as f:
+        f.write('{"rows":[\n')
+        for (i, row) in enumerate(syntheticQueryRows(n_documents, n_conversations, tokens_per_document,
+                                                     vocabulary_size, seed=seed)):
+            f.write(',\n' if i > 0 else '')
+            f.write(f'    {json.dumps(row, separators=(",", ":"))}')
+        f.write('\n]}\n')
+
+
+def syntheticTopicLocations(n_timestamps, n_topics, presence=0.8, seed=0):
+    '''
+        Generate topic locations laid out as by buildDynTopics: every timestamp is a column, and
+        the topics present at that timestamp are spread along it
+
+                Parameters:
+                        n_timestamps (int): n. of timestamps (columns)
+                        n_topics (int): n. of topics
+                        presence (float): probability of a topic being present at a timestamp
+                        seed (int): seed of the random generator
+
+                Returns:
+                        List(TopicLocation): locations
+    '''
+    rng = np.random.default_rng(seed)
+    vocabulary = syntheticVocabulary(10 * n_topics, seed)
+    y = np.sort(rng.random(n_topics)) * n_timestamps
+    locs = []
+    for t in range(n_timestamps):
+        for topic in range(n_topics):
+            if rng.random() >= presence:
+                continue
+            top_terms = [(vocabulary[topic * 10 + i], float(1.0 / (i + 1))) for i in range(10)]
+            locs.append(TopicLocation(
+                x=t,
+                y=float(y[topic]),
+                t=t,
+                id=topic,
+                n=int(rng.integers(1, 1000)),
+                label=','.join([w[0] for w in top_terms[0:5]]),
+                top_terms=top_terms
+            ))
+    return locs
+
+
+'''
+    Fitted topic model, with the topics, topic embeddings and top terms buildDynTopics lays out topics with
+    (as a BERTopic model does)
+'''
+
+
+class SyntheticTopicModel:
+
+    def __init__(self, n_topics, embedding_size=32, seed=0):
+        rng = np.random.default_rng(seed)
+        vocabulary = syntheticVocabulary(10 * n_topics, seed)
+        # Topics, outliers (-1) included, and their embeddings in the same order
+        self.topics = {topic: [(vocabulary[topic * 10 + i], float(1.0 / (i + 1))) for i in range(10)]
+                       for topic in range(n_topics)}
+        self.topics[-1] = []
+        self.topic_embeddings = rng.normal(size=(n_topics + 1, embedding_size))
+
+    def get_topic_freq(self):
+        import pandas as pd
+        return pd.DataFrame({'Topic': sorted(self.topics.keys()), 'Count': 1})
+
+    def get_topics(self):
+        return self.topics
+
+    def get_topic(self, topic):
+        return self.topics[topic]
+
+
+def syntheticTopicsOverTime(n_timestamps, n_topics, presence=0.8, seed=0):
+    '''
+        Generate the frequency of topics at every timestamp, as computed by buildDynTopics
+
+                Parameters:
+                        n_timestamps (int): n. of timestamps
+                        n_topics (int): n. of topics
+                        presence (float): probability of a topic being present at a timestamp
+                        seed (int): seed of the random generator
+
+                Returns:
+                        pandas.DataFrame: frequency of every topic (Topic, Frequency) at every Timestamp
+    '''
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    present = rng.random([n_timestamps, n_topics]) < presence
+    (t, topic) = np.nonzero(present)
+    return pd.DataFrame({'Topic': topic, 'Frequency': rng.integers(1, 1000, len(t)), 'Timestamp': t})